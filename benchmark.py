@@ -0,0 +1,310 @@
+'''
+Scaling benchmarks for latex_normalizer.
+
+Run with "python benchmark.py". Every benchmark times a function on
+inputs of growing size, and prints the time per element of the input.
+For a function running in linear time, that number stays roughly
+constant as the input grows.
+
+The corpus benchmarks then normalize generated documents of growing
+size, see generate_document, and print the time taken by every stage
+and the peak memory used per kilobyte of input.
+
+The exit status is 1 if the time per element of a benchmark, or per
+kilobyte of a corpus profile, grows more than --max-growth times from
+the smallest size to the largest. Run "python benchmark.py --help" for
+the options.
+'''
+import argparse
+import json
+import random
+import sys
+import timeit
+import tracemalloc
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from latex_normalizer import (Normalizer, StageStatistics, _excise_intervals,
+                              _remove_commands, latex_normalizer,
+                              normalize_many)
+
+
+def _best_time(function: Callable[[], object], repeat: int = 3) -> float:
+    '''
+    Return the fastest of several runs of function, in seconds.
+    '''
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def excise_intervals_scaling(sizes: Tuple[int, ...] = (10**3, 10**4, 10**5)
+                             ) -> Iterator[Tuple[int, float]]:
+    '''
+    Time _excise_intervals on a text with the given numbers of
+    intervals, one for each equation in the text.
+    '''
+    for size in sizes:
+        text = 'ab $x$ ' * size
+        intervals = [(7 * index + 3, 7 * index + 5) for index in range(size)]
+        yield size, _best_time(lambda: _excise_intervals(text, intervals))
+
+
+def remove_commands_scaling(sizes: Tuple[int, ...] = (10**3, 10**4, 10**5)
+                            ) -> Iterator[Tuple[int, float]]:
+    '''
+    Time _remove_commands on a text with the given numbers of commands,
+    with and without arguments.
+    '''
+    for size in sizes:
+        text = 'Some \\textbf{bold}[opt] text \\item ' * (size // 2)
+        yield size, _best_time(lambda: _remove_commands(text))
+
+
+_ABSTRACT = ('We prove that \\emph{every} K\\"ahler manifold $X$ '
+             'of dimension $n$ admits a metric, see \\cite{Yau}.')
+
+
+def short_documents_scaling(sizes: Tuple[int, ...] = (10**2, 10**3, 10**4)
+                            ) -> Iterator[Tuple[int, float]]:
+    '''
+    Time a Normalizer on the given numbers of short abstracts, one call
+    per abstract.
+    '''
+    normalizer = Normalizer()
+    for size in sizes:
+        documents = [_ABSTRACT] * size
+        yield size, _best_time(
+            lambda: [normalizer(document) for document in documents])
+
+
+def normalize_many_scaling(sizes: Tuple[int, ...] = (10**2, 10**3, 10**4)
+                           ) -> Iterator[Tuple[int, float]]:
+    '''
+    Time normalize_many on the given numbers of short abstracts.
+    '''
+    for size in sizes:
+        documents = [_ABSTRACT] * size
+        yield size, _best_time(lambda: normalize_many(documents))
+
+
+def recovering_scaling(sizes: Tuple[int, ...] = (10**2, 10**3, 10**4)
+                       ) -> Iterator[Tuple[int, float]]:
+    '''
+    Time latex_normalizer recovering from errors on a text of the given
+    numbers of paragraphs, every one leaving an argument open, followed
+    by a syntax error.
+    '''
+    for size in sizes:
+        text = 'Some \\emph{text\n\n' * size + 'a stray $'
+        yield size, _best_time(
+            lambda: latex_normalizer(text, on_error=lambda _: None))
+
+
+BENCHMARKS = [
+    ('_excise_intervals', 'interval', excise_intervals_scaling),
+    ('_remove_commands', 'command', remove_commands_scaling),
+    ('Normalizer', 'document', short_documents_scaling),
+    ('normalize_many', 'document', normalize_many_scaling),
+    ('latex_normalizer recover', 'paragraph', recovering_scaling),
+]
+
+
+_WORDS = ('the of and a to in is we that for this on with as by are be it '
+          'an our which from at can let proof lemma theorem space map '
+          'group').split()
+
+
+def _paragraph(rng: random.Random) -> str:
+    words = []
+    for _ in range(rng.randint(20, 80)):
+        roll = rng.random()
+        if roll < 0.08:
+            words.append(f'${rng.choice("xyz")}_{{{rng.randint(0, 9)}}} '
+                         f'= \\frac{{a}}{{b}}$')
+        elif roll < 0.1:
+            words.append(f'\\cite{{ref{rng.randint(0, 99)}}}')
+        elif roll < 0.12:
+            words.append(f'\\emph{{{rng.choice(_WORDS)}}}')
+        elif roll < 0.13:
+            words.append('G\\"odel')
+        elif roll < 0.14:
+            words.append(f'\\footnote{{{rng.choice(_WORDS)}.}}')
+        else:
+            words.append(rng.choice(_WORDS))
+    return ' '.join(words) + '.\n\n'
+
+
+def _equations(rng: random.Random) -> str:
+    return rng.choice([
+        '\\begin{equation}\\label{eq:%d}\n  \\int_0^1 f(x)\\,dx = 1\n'
+        '\\end{equation}\n' % rng.randint(0, 999),
+        '$$\n a^2 + b^2 = c^2\n$$\n',
+        '\\begin{align*}\n a &= b \\\\\n c &= d\n\\end{align*}\n',
+        '\\[ x = y \\]\n',
+        ])
+
+
+def _nested_braces(rng: random.Random) -> str:
+    depth = rng.randint(5, 50)
+    return ('\\textbf{' * depth + rng.choice(_WORDS) + '}' * depth
+            + ' \\emph{' + '{' * depth + 'a' + '}' * depth + '}\n')
+
+
+def _preamble(rng: random.Random) -> str:
+    name = ''.join(rng.choice('abcdefgh') for _ in range(6))
+    return rng.choice([
+        f'\\newcommand{{\\{name}}}[1]{{\\mathbb{{#1}}}}\n',
+        f'\\usepackage[utf8]{{{name}}}\n',
+        f'\\DeclareMathOperator{{\\{name}}}{{{name}}}\n',
+        f'\\def\\{name}{{\\operatorname{{{name}}}}}\n',
+        ])
+
+
+def _comments(rng: random.Random) -> str:
+    return ''.join(f'% {" ".join(rng.choices(_WORDS, k=12))} $ {{ [\n'
+                   for _ in range(rng.randint(5, 40)))
+
+
+def _unclosed(rng: random.Random) -> str:
+    if rng.random() < 0.1:
+        return f'{rng.choice(_WORDS)} $ {rng.choice(_WORDS)}\n\n'
+    return f'\\emph{{{" ".join(rng.choices(_WORDS, k=8))}\n\n'
+
+
+# The parts documents are made of, for each kind of document.
+PROFILES: Dict[str, List[Tuple[float, Callable[[random.Random], str]]]] = {
+    'realistic': [(0.7, _paragraph), (0.15, _equations),
+                  (0.05, _preamble), (0.05, _comments),
+                  (0.05, _nested_braces)],
+    'equations': [(0.3, _paragraph), (0.7, _equations)],
+    'nested': [(0.3, _paragraph), (0.7, _nested_braces)],
+    'preamble': [(0.2, _paragraph), (0.8, _preamble)],
+    'comments': [(0.3, _paragraph), (0.7, _comments)],
+    # Arguments left open and stray dollar signs, recovered from.
+    'unclosed': [(0.3, _paragraph), (0.7, _unclosed)],
+}
+
+
+def generate_document(size: int, profile: str = 'realistic',
+                      seed: int = 0) -> str:
+    '''
+    Generate a document of about size characters.
+
+    The document is made of parts, chosen at random with the weights of
+    the profile in PROFILES. The same arguments always give the same
+    document.
+    '''
+    rng = random.Random(seed)
+    weights, parts = zip(*PROFILES[profile])
+    pieces = ['\\documentclass{article}\n\\begin{document}\n']
+    length = len(pieces[0])
+    while length < size:
+        piece = rng.choices(parts, weights)[0](rng)
+        pieces.append(piece)
+        length += len(piece)
+    pieces.append('\\end{document}\n')
+    return ''.join(pieces)
+
+
+def _peak_memory(function: Callable[[], object]) -> int:
+    '''
+    Return the peak memory allocated while running function, in bytes.
+    '''
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def corpus_benchmark(profile: str, sizes: Tuple[int, ...]
+                     ) -> Iterator[Dict[str, object]]:
+    '''
+    Normalize documents of the given sizes, and measure the time taken
+    by every stage and by latex_normalizer, and the peak memory. Syntax
+    errors are recovered from, see latex_normalizer.
+    '''
+    def normalize(text: str, collector: Optional[StageStatistics] = None
+                  ) -> str:
+        return latex_normalizer(text, collector, on_error=lambda _: None)
+
+    for size in sizes:
+        text = generate_document(size, profile)
+        statistics = StageStatistics()
+        normalize(text, statistics)
+        yield {
+            'profile': profile,
+            'size': len(text),
+            'stages': {stage: summary['seconds'] for stage, summary
+                       in statistics.summary().items()},
+            'latex_normalizer': _best_time(lambda: normalize(text)),
+            'peak_memory': _peak_memory(lambda: normalize(text)),
+            }
+
+
+def growth(times: List[Tuple[int, float]]) -> float:
+    '''
+    Return how many times the time per element grows from the smallest
+    size of times, given as sizes and seconds, to the largest.
+    '''
+    (smallest, first), (largest, last) = min(times), max(times)
+    return (last / largest) / (first / smallest)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        '--profiles', nargs='*', default=sorted(PROFILES),
+        choices=sorted(PROFILES), help='kinds of documents to generate')
+    parser.add_argument(
+        '--sizes', nargs='*', type=int, default=[10**4, 10**5, 10**6],
+        help='sizes in characters of the documents to generate')
+    parser.add_argument(
+        '--json', metavar='FILE',
+        help='also write the corpus measurements to FILE as JSON')
+    parser.add_argument(
+        '--max-growth', type=float, default=3.0,
+        help='fail if the time per element grows more than this many '
+        'times from the smallest size to the largest')
+    args = parser.parse_args()
+
+    # The benchmarks whose time per element grows too much.
+    nonlinear = []
+    for name, unit, benchmark in BENCHMARKS:
+        times = []
+        for size, seconds in benchmark():
+            times.append((size, seconds))
+            print(f'{name:<24} {size:>8} {unit}s '
+                  f'{seconds:10.4f} s {seconds / size * 1e6:8.3f} us/{unit}')
+        if growth(times) > args.max_growth:
+            nonlinear.append((name, growth(times)))
+
+    results = []
+    for profile in args.profiles:
+        print()
+        times = []
+        for result in corpus_benchmark(profile, tuple(args.sizes)):
+            results.append(result)
+            times.append((result['size'], result['latex_normalizer']))
+            kilobytes = result['size'] / 1000
+            print(f'{profile:<10} {result["size"]:>9} characters '
+                  f'{result["latex_normalizer"]:8.4f} s '
+                  f'{result["peak_memory"] / 1000 / kilobytes:6.1f} kB/kB')
+            for stage, seconds in result['stages'].items():
+                print(f'    {stage:<28} {seconds / kilobytes * 1e6:8.2f} '
+                      f'us/kB')
+        if len(times) > 1 and growth(times) > args.max_growth:
+            nonlinear.append((f'{profile} corpus', growth(times)))
+    if args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+    if nonlinear:
+        print()
+    for name, factor in nonlinear:
+        print(f'{name}: the time per element grows {factor:.1f} times, '
+              f'more than {args.max_growth} times')
+    return 1 if nonlinear else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,33 +1,1506 @@
+import argparse
+import asyncio
+import bisect
+import codecs
+import concurrent.futures
+import functools
+import glob
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import lzma
+import math
 import os.path
 import re
-from typing import List, Tuple
+import sqlite3
+import string
+import sys
+import tarfile
+import time
+import unicodedata
+import weakref
+import zipfile
+from array import array
+from typing import (Any, BinaryIO, Callable, Container, Dict, Iterable,
+                    Iterator, List, Match, MutableMapping, NamedTuple,
+                    Optional, Pattern, Set, TextIO, Tuple)
 
 
-def latex_normalizer(text: str) -> str:
+# Accent commands that take a letter as argument, as in \c{c}.
+_LETTER_ACCENTS = [
+        'u',
+        'v',
+        'H',
+        't',
+        'c',
+        'd',
+        'b',
+        'k',
+        ]
+# Accent commands that are not letters, as in \"a. These are regex
+# escaped.
+_NON_LETTER_ACCENTS = [
+        r'\'',
+        r'`',
+        r'\^',
+        r'"',
+        r'~',
+        r'=',
+        r'\.',
+        ]
+# The combining marks of the accent commands, used to compose accented
+# letters when Unicode is kept.
+_ACCENT_MARKS = {
+    'u': '\u0306',
+    'v': '\u030c',
+    'H': '\u030b',
+    't': '\u0361',
+    'c': '\u0327',
+    'd': '\u0323',
+    'b': '\u0331',
+    'k': '\u0328',
+    "'": '\u0301',
+    '`': '\u0300',
+    '^': '\u0302',
+    '"': '\u0308',
+    '~': '\u0303',
+    '=': '\u0304',
+    '.': '\u0307',
+}
+# The latin letters with these accents, composed once rather than by
+# every normalizer keeping Unicode.
+_ACCENTED_LETTERS = {
+    (command, letter): unicodedata.normalize('NFC', letter + mark)
+    for command, mark in _ACCENT_MARKS.items()
+    for letter in string.ascii_letters
+    }
+# Commands that are replaced by their argument.
+_NORMALIZED_COMMANDS = [
+    'subsubsection',
+    'subsection',
+    'section',
+    'chapter',
+    'title',
+    'author',
+    'footnote',
+    'emph',
+]
+# Environments that are removed together with their contents. These
+# are regexes.
+_REMOVED_ENVIRONMENTS = [
+    r'comment',
+    r'figure',
+    r'tikzpicture',
+    r'equation\*?',
+    r'multline\*?',
+    r'align\*?',
+    r'gather\*?',
+]
+
+
+class NormalizerConfig(NamedTuple):
+    r'''
+    The commands and environments a Normalizer handles. The defaults are
+    the lists used by latex_normalizer.
+
+    The non-letter accents and the removed environments are regexes, as
+    in _NON_LETTER_ACCENTS and _REMOVED_ENVIRONMENTS.
+
+    If keep_unicode is set, the letters of every alphabet are kept, with
+    their combining marks, instead of the unaccented latin letters only.
+    The accent commands are then replaced by the accented letters, as in
+    G\"odel becoming Gödel.
+
+    >>> default = NormalizerConfig()
+    >>> config = default._replace(
+    ...     normalized_commands=default.normalized_commands + ('textbf',))
+    >>> 'textbf' in config.normalized_commands
+    True
+    '''
+    letter_accents: Tuple[str, ...] = tuple(_LETTER_ACCENTS)
+    non_letter_accents: Tuple[str, ...] = tuple(_NON_LETTER_ACCENTS)
+    normalized_commands: Tuple[str, ...] = tuple(_NORMALIZED_COMMANDS)
+    removed_environments: Tuple[str, ...] = tuple(_REMOVED_ENVIRONMENTS)
+    keep_unicode: bool = False
+
+
+class StageRecord(NamedTuple):
+    '''
+    A measurement of a single stage of normalizing a text.
+
+    The matches are the number of matches of the regexes of the stage in
+    its input, or None for stages that are not driven by regexes.
+    '''
+    stage: str
+    seconds: float
+    input_size: int
+    output_size: int
+    matches: Optional[int]
+
+
+class StageStatistics:
+    r'''
+    Collects the StageRecords of a Normalizer, and aggregates them per
+    stage.
+
+    Pass it as collector to Normalizer or latex_normalizer.
+
+    >>> statistics = StageStatistics()
+    >>> latex_normalizer('\\emph{a} b', collector=statistics)
+    'a b'
+    >>> summary = statistics.summary()
+    >>> summary['_remove_commands']['calls']
+    1
+    >>> summary['_normalize_commands']['matches']
+    1
+    '''
+
+    def __init__(self) -> None:
+        self.records: Dict[str, List[StageRecord]] = {}
+
+    def __call__(self, record: StageRecord) -> None:
+        self.records.setdefault(record.stage, []).append(record)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        '''
+        Return for every stage the number of calls, the total and the
+        percentiles of the time taken, and the total sizes and matches.
+        '''
+        summary = {}
+        for stage, records in self.records.items():
+            seconds = sorted(record.seconds for record in records)
+            summary[stage] = {
+                'calls': len(records),
+                'seconds': sum(seconds),
+                'p50': _percentile(seconds, 0.5),
+                'p90': _percentile(seconds, 0.9),
+                'p99': _percentile(seconds, 0.99),
+                'max': seconds[-1],
+                'input_size': sum(record.input_size for record in records),
+                'output_size': sum(record.output_size
+                                   for record in records),
+                'matches': sum(record.matches for record in records
+                               if record.matches is not None),
+                }
+        return summary
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary(), indent=2)
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    '''
+    Return the nearest rank percentile of the sorted list values.
+
+    >>> _percentile([1, 2, 3, 4], 0.5)
+    2
+    '''
+    rank = max(1, math.ceil(fraction * len(values)))
+    return values[rank - 1]
+
+
+class Diagnostic(NamedTuple):
+    '''
+    A part of a text that was dropped because it could not be
+    normalized, or a text that exceeded its Budget, see
+    Normalizer.__call__.
+
+    The stage is the name of the stage that raised the error, the kind
+    is the message of the error, and the offset and length locate the
+    dropped part in the text.
+    '''
+    stage: str
+    offset: int
+    length: int
+    kind: str
+
+
+class Budget(NamedTuple):
+    r'''
+    Limits on the work of normalizing a single text, see
+    Normalizer.__call__. A limit of None is no limit.
+
+    The size is the length of the text, the depth the nesting depth of
+    its brackets, and the matches the number of backslashes, brackets,
+    dollar and percent signs in it. Every match of the regexes of the
+    stages starts at one of these. They are checked before the first
+    stage. Every stage takes linear time, so that these bound the time
+    taken as well. The seconds are checked after every stage, and
+    between the parts normalized when recovering from errors.
+
+    If a limit is exceeded, the text is normalized by
+    _fallback_normalization instead, and the diagnostic passed to
+    on_error, if any, has the limit in its kind.
+
+    Texts normalized in parts, as by Normalizer.stream, are checked
+    part by part against the limits but the seconds, which are counted
+    for the whole text.
+
+    >>> diagnostics = []
+    >>> latex_normalizer('\\emph{' * 100 + 'Hi % note\n',
+    ...                  budget=Budget(max_depth=10),
+    ...                  on_error=diagnostics.append)
+    'Hi'
+    >>> diagnostics
+    [Diagnostic(stage='', offset=0, length=610, kind='max_depth exceeded')]
+    '''
+    seconds: Optional[float] = None
+    max_size: Optional[int] = None
+    max_depth: Optional[int] = None
+    max_matches: Optional[int] = None
+
+
+class _BudgetExceeded(Exception):
+    '''
+    Raised when the limit of a Budget called guard is exceeded by the
+    stage, or before the first stage if that is empty.
+    '''
+
+    def __init__(self, guard: str, stage: str = '') -> None:
+        super().__init__(f'{guard} exceeded')
+        self.guard = guard
+        self.stage = stage
+
+
+def _deadline(budget: Optional[Budget]) -> Optional[float]:
+    '''
+    Return the time.perf_counter time by which the seconds of budget
+    are up, counted from now, or None if there is no such limit.
+    '''
+    if budget is None or budget.seconds is None:
+        return None
+    return time.perf_counter() + budget.seconds
+
+
+def _check_budget(text: str, budget: Budget) -> None:
+    '''
+    Raise _BudgetExceeded if text exceeds the size, depth or matches
+    limit of budget.
+    '''
+    if budget.max_size is not None and len(text) > budget.max_size:
+        raise _BudgetExceeded('max_size')
+    if budget.max_matches is not None and sum(
+            text.count(character) for character in '\\{}[]$%'
+            ) > budget.max_matches:
+        raise _BudgetExceeded('max_matches')
+    if budget.max_depth is not None \
+            and _bracket_depth(text) > budget.max_depth:
+        raise _BudgetExceeded('max_depth')
+
+
+class OffsetMap:
+    r'''
+    Maps positions in a normalized text back to positions in its
+    source, see Normalizer.normalize_with_offsets.
+
+    The map is run-length encoded: it is made of runs of characters
+    copied unchanged from the source, each given by its start in the
+    normalized text and its start in the source. A position in the
+    normalized text is looked up in time logarithmic in the number of
+    runs. A space between two words maps to the position right after
+    the first of them.
+
+    >>> normalized, offsets = normalize_with_offsets('\\emph{Hi} there')
+    >>> normalized
+    'Hi there'
+    >>> offsets.source_offset(3), offsets.source_span(0, 2)
+    (10, (6, 8))
+    '''
+
+    def __init__(self, starts: array, source_starts: array) -> None:
+        self.starts = starts
+        self.source_starts = source_starts
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def source_offset(self, position: int) -> int:
+        '''
+        Return the position in the source of the character at position
+        in the normalized text.
+        '''
+        run = bisect.bisect_right(self.starts, position) - 1
+        if run < 0:
+            raise IndexError('position before the first run')
+        return self.source_starts[run] + position - self.starts[run]
+
+    def source_span(self, start: int, end: int) -> Tuple[int, int]:
+        '''
+        Return the span in the source of the characters from start to
+        end in the normalized text, such as a word.
+        '''
+        return self.source_offset(start), self.source_offset(end - 1) + 1
+
+
+class Normalizer:
+    r'''
+    Normalizes latex like latex_normalizer, with the commands and
+    environments of config.
+
+    The regexes used by the stages of latex_normalizer are compiled once,
+    when the normalizer is created, instead of on every call. Reuse a
+    normalizer to normalize many texts.
+
+    >>> normalizer = Normalizer()
+    >>> [normalizer(text) for text in ['\\emph{Hi}', 'there $x$']]
+    ['Hi', 'there']
+
+    >>> default = NormalizerConfig()
+    >>> normalizer = Normalizer(NormalizerConfig(
+    ...     normalized_commands=default.normalized_commands + ('textbf',),
+    ...     removed_environments=default.removed_environments
+    ...     + ('lstlisting',)))
+    >>> normalizer('\\textbf{Hi} \\begin{lstlisting}x\\end{lstlisting}')
+    'Hi'
+    '''
+
+    def __init__(self, config: NormalizerConfig = NormalizerConfig()
+                 ) -> None:
+        self.config = config
+        letter_accents = '|'.join(config.letter_accents)
+        non_letter_accents = '|'.join(config.non_letter_accents)
+        normalized_commands = '|'.join(config.normalized_commands)
+        # The names of all removed environments are matched by a single
+        # regex.
+        environments = '|'.join(
+            '(?:' + env + ')' for env in config.removed_environments)
+
+        self._line_comment_regex = re.compile(r'(?<!\\)((?:\\\\)*)%.*\n')
+        if config.keep_unicode:
+            # The accent commands are replaced by accented letters, so
+            # that they also take a letter after them, as in \'e.
+            self._letter_accent_regex = re.compile(
+                    r'\\('
+                    + letter_accents
+                    + r')(?:\ (\w)?|{(\w{1,2})})'
+                    )
+            self._non_letter_accent_regex = re.compile(
+                    r'\\('
+                    + non_letter_accents
+                    + r')(?:{(\w)}|(\w))?'
+                    )
+        else:
+            self._letter_accent_regex = re.compile(
+                    r'\\(?:'
+                    + letter_accents
+                    + r')(?:\ |{(\w{1,2})})'
+                    )
+            self._non_letter_accent_regex = re.compile(
+                    r'\\(?:'
+                    + non_letter_accents
+                    + r')(?:{(\w)})?'
+                    )
+        self._normalized_command_regex = re.compile(
+            r'\\('
+            + normalized_commands
+            + ')(?={)'
+            )
+        self._spaced_normalized_command_regex = re.compile(
+            r'\\('
+            + normalized_commands
+            + ')(?= )'
+            )
+        # The start of a delimiter, whose argument is found by
+        # _environment_delimiters.
+        self._environment_label_regex = re.compile(
+            r'\\(begin|end|label){')
+        self._command_regex = re.compile(r'\\[\w@]*\*?')
+        self._dollar_run_regex = re.compile(r'(?<!\\)(?:\\\\)*(\$+)')
+        self._environment_name_regex = re.compile(environments)
+
+    def __call__(self, text: str,
+                 collector: Optional[Callable[[StageRecord], None]] = None,
+                 on_error: Optional[Callable[[Diagnostic], None]] = None,
+                 budget: Optional[Budget] = None) -> str:
+        '''
+        Normalize text, as latex_normalizer does.
+
+        If a collector is given, it is called with a StageRecord for
+        every stage run.
+
+        If on_error is given, a syntax error does not abort the
+        normalization. The text is then normalized paragraph by
+        paragraph instead, and the paragraphs causing errors are
+        dropped, on_error being called with a Diagnostic for each.
+
+        If a budget is given, the stages are run one by one within its
+        limits, see Budget.
+        '''
+        if budget is not None:
+            return self._budgeted_call(text, budget, collector, on_error)
+        if on_error is not None:
+            try:
+                return self(text, collector)
+            except Exception:
+                return ' '.join(_normalize_recovering(text, on_error, self))
+        if collector is not None:
+            return self._instrumented_call(text, collector)
+        return _remove_special_characters(self._without_markup(text), self)
+
+    def _budgeted_call(self, text: str, budget: Budget,
+                       collector: Optional[Callable[[StageRecord], None]],
+                       on_error: Optional[Callable[[Diagnostic], None]],
+                       deadline: Optional[float] = None) -> str:
+        '''
+        Normalize text within budget, falling back to
+        _fallback_normalization if a limit is exceeded. The seconds are
+        counted from now, unless a time.perf_counter deadline is given.
+        '''
+        if deadline is None:
+            deadline = _deadline(budget)
+        try:
+            try:
+                return self._call_within_budget(text, budget, deadline,
+                                                collector)
+            except _BudgetExceeded:
+                raise
+            except Exception:
+                if on_error is None:
+                    raise
+                return ' '.join(_normalize_recovering(text, on_error, self,
+                                                      deadline=deadline))
+        except _BudgetExceeded as exceeded:
+            if on_error is not None:
+                on_error(Diagnostic(exceeded.stage, 0, len(text),
+                                    str(exceeded)))
+            return _fallback_normalization(text, self)
+
+    def _call_within_budget(
+            self, text: str, budget: Budget, deadline: Optional[float],
+            collector: Optional[Callable[[StageRecord], None]]) -> str:
+        '''
+        Run the stages on text one by one, raising _BudgetExceeded if a
+        limit of budget is exceeded.
+
+        >>> statistics = StageStatistics()
+        >>> Normalizer()._call_within_budget('\\emph{a} b', Budget(), None,
+        ...                                  statistics)
+        'a b'
+        >>> statistics.summary()['_normalize_commands']['matches']
+        1
+        '''
+        _check_budget(text, budget)
+        for name, stage, regex_names in _STAGES:
+            if collector is not None:
+                matches = self._stage_matches(text, regex_names)
+            start = time.perf_counter()
+            output = stage(text, self)
+            end = time.perf_counter()
+            if collector is not None:
+                collector(StageRecord(name, end - start, len(text),
+                                      len(output), matches))
+            text = output
+            if deadline is not None and end > deadline:
+                raise _BudgetExceeded('seconds', name)
+        return text
+
+    def words(self, text: str) -> Iterator[str]:
+        r'''
+        Yield the words of the normalization of text one at a time,
+        without joining them into a string first.
+
+        >>> list(Normalizer().words('\\section{Intro} Hyperk\\"ahler $x$'))
+        ['Intro', 'Hyperkahler']
+        '''
+        text = self._without_markup(text)
+        if self.config.keep_unicode:
+            text = text.translate(_UNICODE_LETTER_TABLE)
+            word_regex = _NON_SPACE_REGEX
+        else:
+            word_regex = _WORD_REGEX
+        for match in word_regex.finditer(text):
+            yield match.group()
+
+    def _without_markup(self, text: str) -> str:
+        '''
+        Run the stages of latex_normalizer but the last one on text,
+        leaving the words to be picked out of what is left.
+        '''
+        text = _remove_line_comments(text, self)
+        text = _remove_accents(text, self)
+        text = _normalize_commands(text, self)
+        text = _remove_environments(text, self)
+        text = _remove_commands(text, self)
+        text = _remove_equations(text, self)
+        return text
+
+    def _accented(self, match: Match) -> str:
+        '''
+        Replace the match of an accent regex, when Unicode is kept, by
+        the accented letters it stands for.
+        '''
+        command, letters = match.group(1), match.group(2) or match.group(3)
+        if not letters:
+            return ''
+        accented = _ACCENTED_LETTERS.get((command, letters))
+        if accented is None:
+            mark = _ACCENT_MARKS.get(command, '')
+            accented = unicodedata.normalize(
+                'NFC', letters[0] + mark + letters[1:])
+        return accented
+
+    def _instrumented_call(self, text: str,
+                           collector: Callable[[StageRecord], None]) -> str:
+        '''
+        Normalize text, timing every stage and passing the measurements
+        to collector.
+        '''
+        for name, stage, regex_names in _STAGES:
+            # Counting the matches is not part of the time taken.
+            matches = self._stage_matches(text, regex_names)
+            start = time.perf_counter()
+            output = stage(text, self)
+            seconds = time.perf_counter() - start
+            collector(StageRecord(name, seconds, len(text), len(output),
+                                  matches))
+            text = output
+        return text
+
+    def _stage_matches(self, text: str,
+                       regex_names: List[str]) -> Optional[int]:
+        '''
+        Count the matches in text of the regexes of the normalizer
+        named regex_names, or return None if there are none.
+        '''
+        if not regex_names:
+            return None
+        return sum(sum(1 for _ in getattr(self, regex_name).finditer(text))
+                   for regex_name in regex_names)
+
+    def normalize_many(self, texts: Any, batch_size: int = 10000) -> Any:
+        r'''
+        Normalize every text in texts, as a list. Missing values, None,
+        NaN or pandas.NA, are left as None. Any other value that is not
+        a string raises TypeError.
+
+        The texts are normalized batch_size at a time, by running the
+        stages once over the short texts of a batch joined together.
+        Longer texts, and texts interacting with their neighbours in
+        the joined text, as in an equation left open, are normalized
+        on their own.
+
+        Joining only pays off for very short texts, such as titles:
+        texts of up to 40 characters are normalized about twice as fast
+        as one at a time, and texts of 40 to 80 about 1.5 times. Texts
+        as long as abstracts take as long as they do one at a time.
+
+        A pandas Series, or a pyarrow array or chunked array, gives a
+        result of the same type, with the index of the series, and the
+        type and chunks of the array.
+
+        >>> Normalizer().normalize_many(['\\emph{Hi}', None, '$x$ there'])
+        ['Hi', None, 'there']
+        >>> Normalizer().normalize_many(['Hi', b'there'])
+        Traceback (most recent call last):
+            ...
+        TypeError: text 1 is of type bytes, not str
+        '''
+        module = type(texts).__module__.split('.')[0]
+        if module in ('pandas', 'pyarrow'):
+            values = texts.tolist() if module == 'pandas' \
+                else texts.to_pylist()
+        else:
+            values = list(texts)
+        results: List[Optional[str]] = [None] * len(values)
+        present = []
+        for index, value in enumerate(values):
+            if isinstance(value, str):
+                present.append(index)
+            elif not _is_missing(value):
+                raise TypeError(f'text {index} is of type '
+                                f'{type(value).__name__}, not str')
+        for batch_start in range(0, len(present), batch_size):
+            batch = present[batch_start:batch_start + batch_size]
+            normalized = _normalize_batch([values[index] for index in batch],
+                                          self)
+            for index, text in zip(batch, normalized):
+                results[index] = text
+        if module == 'pandas':
+            import pandas
+            return pandas.Series(results, index=texts.index,
+                                 name=texts.name, dtype=texts.dtype)
+        if module == 'pyarrow':
+            import pyarrow
+            if isinstance(texts, pyarrow.ChunkedArray):
+                chunks = []
+                position = 0
+                for chunk in texts.chunks:
+                    chunks.append(pyarrow.array(
+                        results[position:position + len(chunk)],
+                        type=texts.type))
+                    position += len(chunk)
+                return pyarrow.chunked_array(chunks, type=texts.type)
+            return pyarrow.array(results, type=texts.type)
+        return results
+
+    def normalize_with_offsets(self, text: str) -> Tuple[str, 'OffsetMap']:
+        '''
+        Normalize text, and map the positions in the result back to
+        positions in text.
+
+        The text is normalized in runs of paragraphs leaving no group,
+        environment or equation open, see _closed_runs, and the words of
+        every run are looked for in its source, see
+        _offset_map_by_search. A word maps to where it is copied from,
+        unless it was glued together from several pieces, or its letters
+        also occur in markup removed before it in the same run.
+        '''
+        starts = array('l')
+        source_starts = array('l')
+        runs = []
+        position = 0
+        run_start = 0
+        for run_end, normalized in _closed_runs(
+                _parallel_parts(text, 0),
+                lambda part, _, last: self(part) if last
+                else _normalize_closed(part, self)):
+            if normalized:
+                offsets = _offset_map_by_search(normalized,
+                                                text[run_start:run_end])
+                starts.extend(position + start for start in offsets.starts)
+                source_starts.extend(run_start + source_start
+                                     for source_start
+                                     in offsets.source_starts)
+                runs.append(normalized)
+                position += len(normalized) + 1
+            run_start = run_end
+        return ' '.join(runs), OffsetMap(starts, source_starts)
+
+    def stream(self, chunks: Iterable[str], chunk_size: int = 2**20,
+               on_error: Optional[Callable[[Diagnostic], None]] = None,
+               budget: Optional[Budget] = None) -> Iterator[str]:
+        r'''
+        Normalize the concatenation of chunks piece by piece.
+
+        The text is split at blank lines outside of every group,
+        environment and equation, see _closed_runs, and the parts are
+        normalized one at a time. Roughly chunk_size characters are held
+        back at a time, unless the text has no such blank lines. Joining
+        the pieces with spaces gives the normalization of the whole
+        text.
+
+        If on_error is given, syntax errors are recovered from as in
+        __call__, with the offsets of the diagnostics in the whole text.
+
+        If a budget is given, its seconds are counted for the whole
+        text, and its other limits for every part, as that is what is
+        normalized at once, see _stream_part.
+
+        >>> normalizer = Normalizer()
+        >>> list(normalizer.stream(['\\emph{Hi}\n\n', '$x\n\n$ there'],
+        ...                        chunk_size=1))
+        ['Hi', 'there']
+
+        Parts running out of time fall back to _fallback_normalization.
+
+        >>> diagnostics = []
+        >>> list(normalizer.stream(['\\emph{Hi}\n\n', '$x$ there'],
+        ...                        chunk_size=1, on_error=diagnostics.append,
+        ...                        budget=Budget(seconds=0)))
+        ['Hi', 'x there']
+        >>> [diagnostic.kind for diagnostic in diagnostics]
+        ['seconds exceeded', 'seconds exceeded']
+        '''
+        deadline = _deadline(budget)
+        for _, normalized in _closed_runs(
+                _blank_line_pieces(chunks, chunk_size),
+                lambda part, offset, last: self._stream_part(
+                    part, last, offset, on_error, budget, deadline),
+                chunk_size):
+            if normalized:
+                yield normalized
+
+    def _stream_part(self, text: str, last: bool, offset: int,
+                     on_error: Optional[Callable[[Diagnostic], None]],
+                     budget: Optional[Budget], deadline: Optional[float]
+                     ) -> Optional[str]:
+        r'''
+        Normalize a part of a text starting at offset, as the start of
+        the rest of the text unless it is the last part, returning None
+        if it is left open, see _normalize_closed. Syntax errors are
+        recovered from as in __call__ if on_error is given.
+
+        If a budget is given, the part is checked against its limits
+        before normalizing it, and against the time.perf_counter
+        deadline after every stage, as in _call_within_budget. A part
+        exceeding them is normalized by _fallback_normalization, even if
+        it is left open, and reported to on_error, if any. Every stage
+        takes linear time, so that the time taken by a part is bounded
+        by its limits, as in __call__.
+
+        >>> diagnostics = []
+        >>> Normalizer()._stream_part('\\emph{Hi} $x\n\n', False, 7,
+        ...                           diagnostics.append,
+        ...                           Budget(max_size=5), None)
+        'Hi x'
+        >>> diagnostics
+        [Diagnostic(stage='', offset=7, length=14, kind='max_size exceeded')]
+        '''
+        try:
+            if budget is not None:
+                _check_budget(text, budget)
+            if deadline is not None and text \
+                    and time.perf_counter() > deadline:
+                raise _BudgetExceeded('seconds')
+            try:
+                if not last:
+                    normalized = _normalize_closed(text, self, deadline)
+                elif deadline is None:
+                    normalized = self(text)
+                else:
+                    normalized = self._call_within_budget(
+                        text, Budget(), deadline, None)
+            except _BudgetExceeded:
+                raise
+            except Exception:
+                if on_error is None:
+                    raise
+                normalized = ' '.join(_normalize_recovering(
+                    text, on_error, self, offset, deadline))
+        except _BudgetExceeded as exceeded:
+            if on_error is not None:
+                on_error(Diagnostic(exceeded.stage, offset, len(text),
+                                    str(exceeded)))
+            return _fallback_normalization(text, self)
+        return normalized
+
+    def stream_file(self, path: str, chunk_size: int = 2**20,
+                    budget: Optional[Budget] = None) -> Iterator[str]:
+        r'''
+        Normalize the file at path piece by piece, as stream does. The
+        file is decoded as UTF-8, or as Latin-1 if it is not valid
+        UTF-8, with universal newlines, see _open_source, and read
+        _READ_SIZE characters at a time, so that only about chunk_size
+        characters of it are held at once.
+
+        A budget is applied as by stream.
+
+        >>> import tempfile
+        >>> with tempfile.TemporaryDirectory() as directory:
+        ...     path = os.path.join(directory, 'old.tex')
+        ...     with open(path, 'wb') as tex_file:
+        ...         _ = tex_file.write(b'G\xf6del \\emph{proved}')
+        ...     list(Normalizer().stream_file(path))
+        ['G del proved']
+        '''
+        with _open_source(path) as file:
+            yield from self.stream(
+                iter(functools.partial(file.read, _READ_SIZE), ''),
+                chunk_size, budget=budget)
+
+    def normalize_parallel(
+            self, text: str,
+            executor: Optional[concurrent.futures.Executor] = None,
+            part_size: int = 2**20, budget: Optional[Budget] = None,
+            on_error: Optional[Callable[[Diagnostic], None]] = None
+            ) -> str:
+        r'''
+        Normalize text, as __call__ does, normalizing parts of it in
+        parallel on executor.
+
+        The text is split after blank lines into parts of about
+        part_size characters, see _parallel_parts, and every part is
+        normalized as the start of the rest of the text, see
+        _normalize_closed. A part leaving a group, environment or
+        equation open is normalized again with the parts following it,
+        until they are closed, so that the result is the same as that of
+        __call__. If a part raises an error, the text is normalized by
+        __call__ instead, which raises the same error as without
+        parallelism.
+
+        If on_error is given, syntax errors are recovered from as in
+        stream, with the offsets of the diagnostics in the whole text.
+
+        The executor is by default created for the call: a thread pool
+        under free-threaded Python, and a process pool otherwise.
+
+        If a budget is given, it is applied as by stream, the seconds
+        being counted for the whole text from the call, in every worker.
+
+        >>> with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        ...     Normalizer().normalize_parallel(
+        ...         '\\emph{a}\n\n$b\n\n$ c\n\nd', executor, part_size=1)
+        'a c d'
+
+        Parts running out of time fall back to _fallback_normalization.
+
+        >>> diagnostics = []
+        >>> with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        ...     Normalizer().normalize_parallel(
+        ...         '\\emph{a}\n\n$b$ c', executor, part_size=1,
+        ...         budget=Budget(seconds=0), on_error=diagnostics.append)
+        'a b c'
+        >>> [diagnostic.kind for diagnostic in diagnostics]
+        ['seconds exceeded', 'seconds exceeded']
+        '''
+        deadline = _deadline(budget)
+        parts = _parallel_parts(text, part_size)
+        if len(parts) == 1:
+            return self(text, on_error=on_error, budget=budget)
+        if executor is None:
+            with _parallel_executor() as executor:
+                return self.normalize_parallel(text, executor, part_size,
+                                               budget, on_error)
+        diagnostics: List[Diagnostic] = []
+        try:
+            # time.perf_counter is system-wide, so that the deadline
+            # holds in the worker processes as well.
+            normalized = ' '.join(self._stitch_parts(
+                parts, list(executor.map(
+                    functools.partial(_normalize_part, config=self.config,
+                                      budget=budget, deadline=deadline,
+                                      report=on_error is not None),
+                    parts, itertools.accumulate(
+                        (len(part) for part in parts), initial=0),
+                    [index == len(parts) - 1
+                     for index in range(len(parts))])),
+                diagnostics.append if on_error is not None else None,
+                budget, deadline))
+        except Exception:
+            pass
+        else:
+            if on_error is not None:
+                for diagnostic in diagnostics:
+                    on_error(diagnostic)
+            return normalized
+        if budget is None:
+            return self(text, on_error=on_error)
+        return self._budgeted_call(text, budget, None, on_error, deadline)
+
+    def _stitch_parts(
+            self, parts: List[str],
+            results: List[Tuple[Optional[str], List[Diagnostic]]],
+            on_error: Optional[Callable[[Diagnostic], None]] = None,
+            budget: Optional[Budget] = None,
+            deadline: Optional[float] = None) -> Iterator[str]:
+        '''
+        Yield the normalizations of consecutive parts of a text, given
+        the results of normalizing every part on its own, by
+        _normalize_part, normalizing the parts left open again with the
+        parts following them, within budget and deadline. The
+        diagnostics of the parts used are passed to on_error.
+        '''
+        # The results are used for the runs of a single part.
+        indices = {start: index for index, start in enumerate(
+            itertools.accumulate((len(part) for part in parts), initial=0))}
+
+        def normalize(text: str, offset: int, last: bool) -> Optional[str]:
+            index = indices[offset]
+            if len(text) == len(parts[index]):
+                normalized, diagnostics = results[index]
+                if normalized is not None and on_error is not None:
+                    for diagnostic in diagnostics:
+                        on_error(diagnostic)
+                return normalized
+            return self._stream_part(text, last, offset, on_error, budget,
+                                     deadline)
+
+        for _, normalized in _closed_runs(parts, normalize):
+            if normalized:
+                yield normalized
+
+
+_DEFAULT_NORMALIZER = Normalizer()
+
+
+def latex_normalizer(text: str,
+                     collector: Optional[Callable[[StageRecord], None]] = None,
+                     on_error: Optional[Callable[[Diagnostic], None]] = None,
+                     budget: Optional[Budget] = None) -> str:
     r'''
     Take a string containing latex syntax,
     and returns a string stripped of that
     syntax. For example,
     "\begin{document} Hi! \end{document}"
     becomes "Hi"
+
+    >>> latex_normalizer('\\section{Intro} Hyperk\\"ahler $x$ % note\n')
+    'Intro Hyperkahler'
+
+    If a collector is given, it is called with a StageRecord for every
+    stage, see StageStatistics.
+
+    If on_error is given, the paragraphs with syntax errors are dropped
+    instead of failing the whole text, and on_error is called with a
+    Diagnostic for each of them.
+
+    >>> diagnostics = []
+    >>> latex_normalizer('A stray $ sign\n\nin \\emph{one} paragraph',
+    ...                  on_error=diagnostics.append)
+    'in one paragraph'
+    >>> [(diagnostic.stage, diagnostic.offset, diagnostic.length)
+    ...  for diagnostic in diagnostics]
+    [('_remove_dollar_equations', 0, 16)]
+
+    If a budget is given, the text is normalized within its limits, or
+    else more crudely, see Budget.
     '''
-    text = _remove_line_comments(text)
-    text = _remove_accents(text)
-    text = _normalize_commands(text)
-    text = _remove_environments(text)
-    text = _strip_environments_labels(text)
-    text = _remove_commands(text)
-    text = _remove_equations(text)
-    text = _remove_special_characters(text)
-    text = _remove_white_space(text)
-    return text
+    return _DEFAULT_NORMALIZER(text, collector, on_error, budget)
+
+
+def normalize_with_offsets(text: str) -> Tuple[str, OffsetMap]:
+    r'''
+    Normalize text like latex_normalizer, and return the result with an
+    OffsetMap, see Normalizer.normalize_with_offsets.
+
+    >>> normalized, offsets = normalize_with_offsets('G\\"odel % x\nproved')
+    >>> [offsets.source_span(*match.span())
+    ...  for match in re.finditer(r'\w+', normalized)]
+    [(0, 7), (12, 18)]
+    '''
+    return _DEFAULT_NORMALIZER.normalize_with_offsets(text)
+
+
+def latex_words(text: str) -> Iterator[str]:
+    r'''
+    Yield the words of latex_normalizer(text) one at a time, see
+    Normalizer.words.
+
+    >>> list(latex_words('\\emph{Hi} there $x$'))
+    ['Hi', 'there']
+    '''
+    return _DEFAULT_NORMALIZER.words(text)
+
+
+class PackedWords:
+    r'''
+    Words packed into a single UTF-8 buffer, data, with an array of
+    len(self) + 1 64-bit offsets into it, the i-th word being
+    data[offsets[i]:offsets[i + 1]].
+
+    This is the layout of an Arrow large string array, see to_arrow.
+    Both buffers support the buffer protocol, so that NumPy can view
+    them without copying, with numpy.frombuffer(packed.offsets,
+    numpy.int64) and numpy.frombuffer(packed.data, numpy.uint8). Write
+    them to files to memory-map them later.
+
+    >>> packed = pack_words(latex_words('\\emph{Hi} there $x$'))
+    >>> len(packed), packed[1], list(packed)
+    (2, 'there', ['Hi', 'there'])
+    >>> bytes(packed.data), list(packed.offsets)
+    (b'Hithere', [0, 2, 7])
+    '''
+
+    def __init__(self, data: bytes, offsets: array) -> None:
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('word index out of range')
+        return str(self.data[self.offsets[index]:self.offsets[index + 1]],
+                   'utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def to_arrow(self) -> Any:
+        '''
+        Return the words as a pyarrow large string array, sharing the
+        buffers of self.
+        '''
+        import pyarrow
+        return pyarrow.LargeStringArray.from_buffers(
+            len(self), pyarrow.py_buffer(self.offsets),
+            pyarrow.py_buffer(self.data))
+
+
+def pack_words(words: Iterable[str]) -> PackedWords:
+    '''
+    Pack words, such as those yielded by latex_words, into a
+    PackedWords.
+    '''
+    data = bytearray()
+    offsets = array('q', [0])
+    for word in words:
+        data += word.encode('utf-8')
+        offsets.append(len(data))
+    return PackedWords(data, offsets)
+
+
+def normalize_parallel(text: str,
+                       executor: Optional[concurrent.futures.Executor] = None,
+                       part_size: int = 2**20,
+                       budget: Optional[Budget] = None,
+                       on_error: Optional[Callable[[Diagnostic], None]] = None
+                       ) -> str:
+    r'''
+    Normalize a long text like latex_normalizer, with parts of it
+    normalized in parallel. See Normalizer.normalize_parallel.
+
+    >>> normalize_parallel('\\emph{One}\n\ntwo', part_size=1)
+    'One two'
+    '''
+    return _DEFAULT_NORMALIZER.normalize_parallel(text, executor, part_size,
+                                                  budget, on_error)
+
+
+def _parallel_parts(text: str, part_size: int) -> List[str]:
+    r'''
+    Split text into parts of at least part_size characters, every part
+    but the last ending at the first blank line it can.
+
+    >>> _parallel_parts('ab\n\ncd\n\n\nef\n\n', 3)
+    ['ab\n\n', 'cd\n\n', '\nef\n\n']
+    '''
+    parts = []
+    position = 0
+    while True:
+        split_pos = text.find('\n\n',
+                              position + max(part_size - 2, 0)) + 2
+        if split_pos == 1 or split_pos >= len(text):
+            break
+        parts.append(text[position:split_pos])
+        position = split_pos
+    parts.append(text[position:])
+    return parts
+
+
+def _parallel_executor() -> concurrent.futures.Executor:
+    '''
+    Create the executor of normalize_parallel: a thread pool if threads
+    run in parallel, as under free-threaded Python, and a process pool
+    otherwise.
+    '''
+    if not getattr(sys, '_is_gil_enabled', lambda: True)():
+        return concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+    return concurrent.futures.ProcessPoolExecutor()
+
+
+def _is_missing(value: Any) -> bool:
+    '''
+    Whether value is a missing value for normalize_many: None, NaN or
+    pandas.NA.
+
+    >>> [_is_missing(value) for value in [None, float('nan'), 0.0, '']]
+    [True, True, False, False]
+    '''
+    if value is None:
+        return True
+    if isinstance(value, float):
+        return math.isnan(value)
+    return type(value).__name__ == 'NAType'
+
+
+def normalize_many(texts: Any, batch_size: int = 10000) -> Any:
+    r'''
+    Normalize many texts at once, like latex_normalizer. Only very short
+    texts, such as titles, are normalized faster than one at a time, up
+    to about twice as fast. See Normalizer.normalize_many.
+
+    >>> normalize_many(['\\section{One}', 'two % three\n'])
+    ['One', 'two']
+    '''
+    return _DEFAULT_NORMALIZER.normalize_many(texts, batch_size)
+
+
+class IncrementalNormalizer:
+    r'''
+    Keeps the normalization of a text up to date as the text is edited.
 
+    The text is split into segments ending at blank lines outside of
+    every group, environment and equation, see _closed_runs, and the
+    normalization of every segment is kept. An edit normalizes the
+    segments from the one it starts in again, until a segment ends
+    where one did before the edit. The segments after it are unchanged,
+    and so is their normalization. The result is always that of
+    normalizing the whole text.
 
-def tex_file_normalizer(path: str) -> None:
+    Segments are at least segment_size characters long, where the text
+    allows it.
+
+    >>> document = IncrementalNormalizer('\\emph{One}\n\ntwo $x$\n\nthree')
+    >>> document.normalized
+    'One two three'
+    >>> document.edit(12, 15, 'four')
+    'One four three'
+    >>> document.update('\\emph{One}\n\nfour $x$\n\nthree \\emph{five}')
+    'One four three five'
+    '''
+
+    def __init__(self, text: str = '',
+                 normalizer: Normalizer = _DEFAULT_NORMALIZER,
+                 segment_size: int = 2**12) -> None:
+        self.text = text
+        self.normalizer = normalizer
+        self.segment_size = segment_size
+        # The start of every segment and its normalization, None for a
+        # last segment that could not be normalized yet.
+        self._starts: List[int] = [0] if text else []
+        self._outputs: List[Optional[str]] = [None] if text else []
+
+    @property
+    def normalized(self) -> str:
+        '''
+        The normalization of the current text.
+        '''
+        if self._outputs and self._outputs[-1] is None:
+            self._normalize_from(len(self._outputs) - 1, [])
+        return ' '.join(output for output in self._outputs if output)
+
+    def edit(self, start: int, end: int, replacement: str) -> str:
+        '''
+        Replace the characters of the text from start to end by
+        replacement, and return the normalization of the new text.
+
+        If the new text can not be normalized, the error is raised, and
+        the normalization is attempted again on the next edit.
+        '''
+        if not 0 <= start <= end <= len(self.text):
+            raise ValueError('edit out of range')
+        shift = len(replacement) - (end - start)
+        first = max(0, bisect.bisect_right(self._starts, start) - 1)
+        later = max(first + 1, bisect.bisect_left(self._starts, end))
+        reused = [(segment_start + shift, output) for segment_start, output
+                  in zip(self._starts[later:], self._outputs[later:])]
+        self.text = self.text[:start] + replacement + self.text[end:]
+        self._normalize_from(first, reused)
+        return self.normalized
+
+    def update(self, text: str) -> str:
+        '''
+        Replace the text by text, and return its normalization. Only
+        the part between the common prefix and suffix of the old and
+        new texts is treated as edited.
+        '''
+        prefix = _common_prefix_length(self.text, text)
+        suffix = _common_prefix_length(self.text[prefix:][::-1],
+                                       text[prefix:][::-1])
+        return self.edit(prefix, len(self.text) - suffix,
+                         text[prefix:len(text) - suffix])
+
+    def _normalize_from(self, first: int,
+                        reused: List[Tuple[int, Optional[str]]]) -> None:
+        '''
+        Split the text into segments again from the start of the
+        segment at index first, until reaching the start of one of the
+        reused segments, which are kept from there on. A last segment
+        without normalization is normalized by the next access to
+        normalized.
+        '''
+        position = self._starts[first] if first < len(self._starts) else 0
+        del self._starts[first:]
+        del self._outputs[first:]
+        reused_starts = [start for start, _ in reused]
+        # A segment may end early at the start of a reused segment.
+        try:
+            if self._reuse(position, reused, reused_starts):
+                return
+            for end, normalized in _closed_runs(
+                    self._pieces(position), self._normalize_piece,
+                    self.segment_size, position, set(reused_starts)):
+                self._starts.append(position)
+                self._outputs.append(normalized)
+                position = end
+                if self._reuse(position, reused, reused_starts):
+                    return
+        except Exception:
+            self._starts.append(position)
+            self._outputs.append(None)
+            raise
+
+    def _reuse(self, position: int, reused: List[Tuple[int, Optional[str]]],
+               reused_starts: List[int]) -> bool:
+        '''
+        Keep the reused segments from the one starting at position on,
+        if there is one, and return whether there is.
+        '''
+        index = bisect.bisect_left(reused_starts, position)
+        if index == len(reused) or reused_starts[index] != position:
+            return False
+        for segment_start, output in reused[index:]:
+            self._starts.append(segment_start)
+            self._outputs.append(output)
+        return True
+
+    def _pieces(self, position: int) -> Iterator[str]:
+        '''
+        Yield the text from position on split after every blank line.
+        '''
+        text = self.text
+        for match in _SEGMENT_BOUNDARY_REGEX.finditer(text, position + 1):
+            yield text[position:match.end()]
+            position = match.end()
+        if position < len(text):
+            yield text[position:]
+
+    def _normalize_piece(self, text: str, position: int,
+                         last: bool) -> Optional[str]:
+        '''
+        Normalize the segment text starting at position, for
+        _closed_runs.
+        '''
+        if last:
+            return self.normalizer(text)
+        return _normalize_closed(text, self.normalizer)
+
+
+# The places where a text can be split into segments, after a blank
+# line.
+_SEGMENT_BOUNDARY_REGEX = re.compile('(?<=\n\n)')
+
+
+def _common_prefix_length(first: str, second: str) -> int:
+    '''
+    Return the length of the longest common prefix of two strings.
+
+    >>> _common_prefix_length('abcd', 'abd')
+    2
+    '''
+    # Search for the length, comparing slices instead of characters.
+    low, high = 0, min(len(first), len(second))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[:middle] == second[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+# The number of characters read from a file at a time.
+_READ_SIZE = 2**16
+
+
+def _source_encoding(chunks: Iterable[bytes]) -> str:
+    r'''
+    Return the encoding of a tex file read as chunks: UTF-8 if it is
+    valid UTF-8, and Latin-1 otherwise, as many older sources are. The
+    chunks are checked one at a time, without decoding the whole file
+    at once.
+
+    >>> _source_encoding([b'G\xc3', b'\xb6del']), _source_encoding([b'\xf6'])
+    ('utf-8', 'latin-1')
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in chunks:
+            decoder.decode(chunk)
+        decoder.decode(b'', True)
+    except UnicodeDecodeError:
+        return 'latin-1'
+    return 'utf-8'
+
+
+def _open_source(path: str) -> TextIO:
+    '''
+    Open the tex file at path as text, with universal newlines, in the
+    encoding found by _source_encoding.
+    '''
+    with open(path, 'rb') as file:
+        encoding = _source_encoding(
+            iter(functools.partial(file.read, _READ_SIZE), b''))
+    return open(path, 'r', encoding=encoding)
+
+
+# The version of the normalization rules, hashed into the keys of
+# NormalizationCache. Increase it with every change to the stages that
+# changes the result for some text, so that results cached by earlier
+# versions are not used.
+_RULES_VERSION = 1
+
+
+class NormalizationCache:
+    r'''
+    An on-disk cache of normalized texts, stored in an sqlite database
+    at path.
+
+    Results are looked up by a hash of the text, the configuration of
+    the normalizer and the version of the rules. Once the cached
+    results take up more than max_size bytes, the least recently used
+    ones are evicted. The numbers of lookups that were and were not
+    found are counted in hits and misses.
+
+    >>> cache = NormalizationCache(':memory:')
+    >>> [cache.normalize('\\emph{Hi}') for _ in range(2)]
+    ['Hi', 'Hi']
+    >>> cache.hits, cache.misses
+    (1, 1)
+    '''
+
+    def __init__(self, path: str, max_size: int = 2**30) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Several processes may use the same cache, so wait for locks
+        # held by others.
+        self._connection = sqlite3.connect(path, timeout=60)
+        with self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, value TEXT, size INTEGER, '
+                'last_used REAL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS results_last_used '
+                'ON results (last_used)')
+            # The total size of the results, kept up to date so that it
+            # does not have to be summed up on every insertion.
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS total (size INTEGER)')
+            if self._connection.execute(
+                    'SELECT size FROM total').fetchone() is None:
+                self._connection.execute('INSERT INTO total VALUES (0)')
+
+    def __enter__(self) -> 'NormalizationCache':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    @staticmethod
+    def key(chunks: Iterable[str],
+            normalizer: Normalizer = _DEFAULT_NORMALIZER,
+            budget: Optional[Budget] = None) -> str:
+        '''
+        Hash the concatenation of chunks, the configuration of
+        normalizer, the budget, if any, and the version of the rules.
+        '''
+        header = f'{_RULES_VERSION}\n{normalizer.config!r}'
+        if budget is not None:
+            header += f'\n{budget!r}'
+        digest = hashlib.sha256(header.encode())
+        for chunk in chunks:
+            digest.update(chunk.encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        '''
+        Return the result cached under key, or None if there is none.
+        '''
+        with self._connection:
+            row = self._connection.execute(
+                'SELECT value FROM results WHERE key = ?', (key,)
+                ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                'UPDATE results SET last_used = ? WHERE key = ?',
+                (time.time(), key))
+        self.hits += 1
+        return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        '''
+        Cache value under key, evicting results if the cache grows
+        too large.
+
+        The total size is summed up again if it is out of step with the
+        results, as after a crash or a manual deletion.
+
+        >>> cache = NormalizationCache(':memory:', max_size=10)
+        >>> with cache._connection:
+        ...     _ = cache._connection.execute('UPDATE total SET size = 100')
+        >>> cache.put('key', 'value')
+        >>> cache._connection.execute('SELECT size FROM total').fetchone()
+        (0,)
+        '''
+        size = len(value.encode('utf-8', 'surrogatepass'))
+        with self._connection:
+            inserted = self._connection.execute(
+                'INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?)',
+                (key, value, size, time.time())).rowcount
+            if not inserted:
+                return
+            self._connection.execute(
+                'UPDATE total SET size = size + ?', (size,))
+            total_size, = self._connection.execute(
+                'SELECT size FROM total').fetchone()
+            while total_size > self.max_size:
+                evicted = self._connection.execute(
+                    'SELECT key, size FROM results ORDER BY last_used '
+                    'LIMIT 64').fetchall()
+                if not evicted:
+                    total_size, = self._connection.execute(
+                        'SELECT COALESCE(SUM(size), 0) FROM results'
+                        ).fetchone()
+                    break
+                for evicted_key, evicted_size in evicted:
+                    self._connection.execute(
+                        'DELETE FROM results WHERE key = ?', (evicted_key,))
+                    total_size -= evicted_size
+                    if total_size <= self.max_size:
+                        break
+            self._connection.execute(
+                'UPDATE total SET size = ?', (total_size,))
+
+    def normalize(self, text: str,
+                  normalizer: Normalizer = _DEFAULT_NORMALIZER,
+                  budget: Optional[Budget] = None) -> str:
+        '''
+        Normalize text with normalizer within budget, using the cached
+        result if there is one.
+
+        Results are cached under their budget, even if they exceeded it
+        and were only normalized by _fallback_normalization, so that a
+        text too costly to normalize is not tried again with the same
+        budget.
+        '''
+        key = self.key([text], normalizer, budget)
+        normalized = self.get(key)
+        if normalized is None:
+            normalized = normalizer(text, budget=budget)
+            self.put(key, normalized)
+        return normalized
+
+    def normalize_file(self, path: str,
+                       normalizer: Normalizer = _DEFAULT_NORMALIZER,
+                       budget: Optional[Budget] = None) -> str:
+        '''
+        Normalize the file at path with normalizer within budget, using
+        the cached result if there is one, as normalize does.
+
+        The file is read in chunks, once to compute its key, and once
+        more to normalize it if it is not cached.
+        '''
+        with _open_source(path) as file:
+            key = self.key(
+                iter(functools.partial(file.read, _READ_SIZE), ''),
+                normalizer, budget)
+        normalized = self.get(key)
+        if normalized is None:
+            normalized = _normalize_file_contents(path, normalizer,
+                                                  budget=budget)
+            self.put(key, normalized)
+        return normalized
+
+
+def _normalize_file_contents(
+        path: str,
+        normalizer: Normalizer = _DEFAULT_NORMALIZER,
+        on_error: Optional[Callable[[Diagnostic], None]] = None,
+        budget: Optional[Budget] = None) -> str:
+    '''
+    Normalize the file at path, reading it in chunks, within budget.
+    '''
+    if on_error is None:
+        return ' '.join(normalizer.stream_file(path, budget=budget))
+    with _open_source(path) as file:
+        return ' '.join(normalizer.stream(
+            iter(functools.partial(file.read, _READ_SIZE), ''),
+            on_error=on_error, budget=budget))
+
+
+def tex_file_normalizer(path: str,
+                        cache: Optional[NormalizationCache] = None) -> None:
     '''
     Takes path to original tex file, "original"
     and writes normalized version to "original_normalized"
     in the same directory.
+
+    If a cache is given, the result is looked up in it first.
     '''
     abs_path = os.path.realpath(path)
     directory, file_name = os.path.split(abs_path)
@@ -42,625 +1515,2625 @@ def tex_file_normalizer(path: str) -> None:
         else:
             return
 
-    # Opens the tex file, and normalizes the result.
-    with open(path, 'r') as file:
-        text = file.read()
-    text = latex_normalizer(text)
+    if cache is not None:
+        text = cache.normalize_file(path)
+        with open(normalized_path, 'a',
+                  encoding='utf-8') as normalized_file:
+            normalized_file.write(text)
+        return
 
-    # Writes the result to a file named original_file_name_normalized.
-    with open(normalized_path, 'a') as normalized_file:
-        normalized_file.write(text)
+    # Reads the tex file in parts, and writes the normalized result to
+    # a file named original_file_name_normalized as it comes in.
+    with open(normalized_path, 'ab') as normalized_file:
+        separator = b''
+        for normalized in _DEFAULT_NORMALIZER.stream_file(path):
+            normalized_file.write(separator + normalized.encode())
+            separator = b' '
 
 
-def _matching_paren_pos(string: str, open_paren: str = '{',
-                        close_paren: str = '}') -> int:
-    r'''
-    Find the position of the parenthesis closing the one a string
-    starts with.
+class _ProjectFile(NamedTuple):
+    '''
+    A file of a TexProject, as last read.
+    '''
+    mtime_ns: int
+    size: int
+    text: str
+    # The text without comments, split at the include commands, and
+    # the commands and file names of these.
+    pieces: List[str]
+    includes: List[Tuple[str, str]]
+    # The normalization of every piece, by whether the file is the
+    # root, or None if a piece is left open.
+    fragments: Dict[bool, Optional[List[str]]]
 
-    >>> _matching_paren_pos('{{a}{}}b')
+
+class TexProject:
+    r'''
+    Normalizes a latex project made of several files, following the
+    \input and \include commands from the root file.
+
+    Every \input{name} or \include{name} outside of comments is replaced
+    by the file it names surrounded by blank lines, and the result is
+    normalized. As in latex, names are relative to the directory of the
+    root file, .tex is appended to names without an extension, and a
+    missing \include file is skipped while a missing \input file is an
+    error.
+
+    The files of every level of includes are read concurrently, by
+    max_workers threads. The pieces of the files between includes are
+    normalized separately, and the results are kept for every file
+    until its modification time or size changes. If a cache is given,
+    they are also stored in it under a hash of the file. Normalizing
+    the project again thus only normalizes the files that changed. If
+    a piece leaves a group, environment or equation open, or cannot be
+    normalized on its own, the whole project is normalized at once
+    instead, since a piece may close what an included file opened.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     root = os.path.join(directory, 'main.tex')
+    ...     with open(root, 'w') as tex_file:
+    ...         _ = tex_file.write('Intro \\input{open} y$ text')
+    ...     with open(os.path.join(directory, 'open.tex'), 'w') as tex_file:
+    ...         _ = tex_file.write('$x')
+    ...     TexProject(root).normalize()
+    'Intro text'
+    '''
+
+    def __init__(self, root: str,
+                 normalizer: Normalizer = _DEFAULT_NORMALIZER,
+                 cache: Optional[NormalizationCache] = None,
+                 max_workers: Optional[int] = None) -> None:
+        self.root = os.path.normpath(root)
+        self.directory = os.path.dirname(self.root)
+        self.normalizer = normalizer
+        self.cache = cache
+        self.max_workers = max_workers
+        self._files: Dict[str, _ProjectFile] = {}
+
+    def normalize(self,
+                  on_error: Optional[Callable[[Diagnostic], None]] = None,
+                  budget: Optional[Budget] = None) -> str:
+        '''
+        Normalize the project as its files are now.
+
+        If on_error is given, syntax errors are recovered from as in
+        Normalizer.__call__, the offsets of the diagnostics being in
+        the text with the included files in place.
+
+        If a budget is given, the text with the included files in place
+        is normalized at once within it, as its limits are on the whole
+        project rather than on its files, and cached as a whole unless
+        recovered from errors.
+        '''
+        self._load()
+        if budget is not None:
+            text = self._expand(self.root)
+            if self.cache is not None and on_error is None:
+                return self.cache.normalize(text, self.normalizer, budget)
+            return self.normalizer(text, on_error=on_error, budget=budget)
+        try:
+            fragments = self._fragments(self.root, True, ())
+        except Exception:
+            if on_error is None:
+                raise
+            fragments = None
+        if fragments is None:
+            return self.normalizer(self._expand(self.root),
+                                   on_error=on_error)
+        return ' '.join(fragment for fragment in fragments if fragment)
+
+    def _load(self) -> None:
+        '''
+        Read the files of the project that changed since they were last
+        read, level by level of includes. A missing root file is an
+        error, as a missing \\input file is.
+
+        >>> TexProject('no/such/main.tex').normalize()
+        Traceback (most recent call last):
+            ...
+        FileNotFoundError: no/such/main.tex does not exist
+        '''
+        files = {}
+        level = [self.root]
+        with concurrent.futures.ThreadPoolExecutor(
+                self.max_workers) as executor:
+            while level:
+                for path, file in zip(level,
+                                      executor.map(self._load_file, level)):
+                    if file is not None:
+                        files[path] = file
+                level = sorted({
+                    self._included_path(command, name)
+                    for path in level if path in files
+                    for command, name in files[path].includes} - set(files))
+        if self.root not in files:
+            raise FileNotFoundError(f'{self.root} does not exist')
+        self._files = files
+
+    def _load_file(self, path: str) -> Optional[_ProjectFile]:
+        '''
+        Read the file at path, unless it is unchanged. Returns None if
+        there is no such file.
+        '''
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        file = self._files.get(path)
+        if file is not None and (file.mtime_ns, file.size) \
+                == (stat.st_mtime_ns, stat.st_size):
+            return file
+        with _open_source(path) as tex_file:
+            text = tex_file.read()
+        pieces, includes = _split_includes(
+            _remove_line_comments(text, self.normalizer))
+        return _ProjectFile(stat.st_mtime_ns, stat.st_size, text, pieces,
+                            includes, {})
+
+    def _included_path(self, command: str, name: str) -> str:
+        path = os.path.normpath(os.path.join(self.directory, name.strip()))
+        if command == 'include' or not os.path.splitext(path)[1]:
+            path += '.tex'
+        return path
+
+    def _children(self, path: str, including: Tuple[str, ...]
+                  ) -> Iterator[Optional[str]]:
+        r'''
+        Yield the path of every file included by the file at path, or
+        None for the missing \include files.
+        '''
+        for command, name in self._files[path].includes:
+            child = self._included_path(command, name)
+            if child == path or child in including:
+                raise Exception(f'{child} includes itself')
+            if child in self._files:
+                yield child
+            elif command == 'include':
+                yield None
+            else:
+                raise FileNotFoundError(f'{child} input by {path} does not '
+                                        f'exist')
+
+    def _fragments(self, path: str, root: bool, including: Tuple[str, ...]
+                   ) -> Optional[List[str]]:
+        '''
+        Return the normalizations of the pieces of the file at path and
+        of the files it includes, in order, or None if one of the
+        pieces is left open.
+        '''
+        own_fragments = self._own_fragments(path, root)
+        if own_fragments is None:
+            return None
+        fragments = [own_fragments[0]]
+        for child, fragment in zip(self._children(path, including),
+                                   own_fragments[1:]):
+            if child is not None:
+                child_fragments = self._fragments(child, False,
+                                                  including + (path,))
+                if child_fragments is None:
+                    return None
+                fragments.extend(child_fragments)
+            fragments.append(fragment)
+        return fragments
+
+    def _own_fragments(self, path: str, root: bool) -> Optional[List[str]]:
+        '''
+        Return the normalizations of the pieces of the file at path, or
+        None if one of them is left open or raises. Every piece is
+        followed by a blank line, except for the last one of the root
+        file.
+        '''
+        file = self._files[path]
+        if root in file.fragments:
+            return file.fragments[root]
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(['\\input fragments\n', str(root), '\n',
+                                  file.text], self.normalizer)
+            cached = self.cache.get(key)
+            if cached is not None:
+                file.fragments[root] = json.loads(cached)
+                return file.fragments[root]
+        fragments: Optional[List[str]] = []
+        for index, piece in enumerate(file.pieces):
+            try:
+                if root and index == len(file.pieces) - 1:
+                    fragment = self.normalizer(piece)
+                else:
+                    fragment = _normalize_closed(piece + '\n\n',
+                                                 self.normalizer)
+            except Exception:
+                # The error may be in what an included file opened, as
+                # in '\input{a} b$' with a.tex opening an equation.
+                fragment = None
+            if fragment is None:
+                fragments = None
+                break
+            fragments.append(fragment)
+        file.fragments[root] = fragments
+        if key is not None:
+            self.cache.put(key, json.dumps(fragments))
+        return fragments
+
+    def _expand(self, path: str, including: Tuple[str, ...] = ()) -> str:
+        '''
+        Return the text of the file at path without comments, with the
+        files it includes in place of the include commands.
+        '''
+        file = self._files[path]
+        parts = [file.pieces[0]]
+        for child, piece in zip(self._children(path, including),
+                                file.pieces[1:]):
+            parts.append('\n\n')
+            if child is not None:
+                parts.append(self._expand(child, including + (path,)))
+            parts.append('\n\n')
+            parts.append(piece)
+        return ''.join(parts)
+
+
+def normalize_project(root: str,
+                      cache: Optional[NormalizationCache] = None,
+                      budget: Optional[Budget] = None) -> str:
+    '''
+    Normalize the latex project with root file root, see TexProject.
+    '''
+    return TexProject(root, cache=cache).normalize(budget=budget)
+
+
+# Matches the commands including other files, with the file name.
+_INCLUDE_REGEX = re.compile(r'\\(input|include)(?![a-zA-Z@])\s*{([^{}]*)}')
+
+
+def _split_includes(text: str) -> Tuple[List[str], List[Tuple[str, str]]]:
+    r'''
+    Split text at the commands including other files. Returns the
+    pieces of text between the commands, and the name and argument of
+    every command.
+
+    >>> pieces, includes = _split_includes(
+    ...     'a \\input{one} b \\includegraphics{x}\\include{two}')
+    >>> pieces
+    ['a ', ' b \\includegraphics{x}', '']
+    >>> includes
+    [('input', 'one'), ('include', 'two')]
+    '''
+    pieces = []
+    includes = []
+    position = 0
+    for match in _INCLUDE_REGEX.finditer(text):
+        pieces.append(text[position:match.start()])
+        includes.append((match.group(1), match.group(2)))
+        position = match.end()
+    pieces.append(text[position:])
+    return pieces, includes
+
+
+# The default timeout and budget of the AsyncNormalizer methods,
+# standing for those of the normalizer, since None means no limit.
+_DEFAULT_TIMEOUT: Any = object()
+_DEFAULT_BUDGET: Any = object()
+
+
+def _release_threadsafe(loop: asyncio.AbstractEventLoop,
+                        semaphore: asyncio.Semaphore,
+                        future: concurrent.futures.Future) -> None:
+    '''
+    Release semaphore in loop, from any thread, unless loop is closed.
+    '''
+    try:
+        loop.call_soon_threadsafe(semaphore.release)
+    except RuntimeError:
+        pass
+
+
+class AsyncNormalizer:
+    r'''
+    Normalizes texts and files without blocking the event loop.
+
+    The work is done in executor, a process pool with max_workers
+    processes by default. At most max_pending calls are handed to the
+    executor at a time, further calls wait for one of them to finish.
+    A call taking longer than its timeout, or the default timeout if
+    none is given, is cancelled and raises asyncio.TimeoutError; a
+    timeout of None waits as long as it takes. A call that has already
+    started in the executor runs to completion there, since neither
+    threads nor pool processes can be interrupted, and keeps its place
+    among the max_pending until then.
+
+    To keep a pathological text from holding up a worker that long, a
+    budget can be given, by default or for a call, within which the
+    worker normalizes the text, see Budget. Files are normalized within
+    it as by Normalizer.stream_file.
+
+    The limit is kept separately for every event loop the normalizer
+    is used in, since asyncio primitives belong to a single loop.
+
+    >>> async def normalize_both():
+    ...     with concurrent.futures.ThreadPoolExecutor(2) as executor:
+    ...         async with AsyncNormalizer(executor) as normalizer:
+    ...             return await asyncio.gather(
+    ...                 normalizer.normalize('\\emph{a}'),
+    ...                 normalizer.normalize('b $c$'))
+    >>> asyncio.run(normalize_both())
+    ['a', 'b']
+    '''
+
+    def __init__(self,
+                 executor: Optional[concurrent.futures.Executor] = None,
+                 max_workers: Optional[int] = None,
+                 max_pending: Optional[int] = None,
+                 timeout: Optional[float] = None,
+                 normalizer: Normalizer = _DEFAULT_NORMALIZER,
+                 budget: Optional[Budget] = None) -> None:
+        # Only shut down the executor if it was created here.
+        self._owns_executor = executor is None
+        if executor is None:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+        self._executor = executor
+        if max_pending is None:
+            max_pending = 4 * (max_workers or os.cpu_count() or 1)
+        self.max_pending = max_pending
+        self._semaphores: MutableMapping[asyncio.AbstractEventLoop,
+                                         asyncio.Semaphore] = \
+            weakref.WeakKeyDictionary()
+        self.timeout = timeout
+        self.budget = budget
+        # The configuration is sent to the workers rather than the
+        # normalizer, which they build once.
+        self._config = normalizer.config
+
+    async def __aenter__(self) -> 'AsyncNormalizer':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, function: Callable[..., str], argument: str,
+                   timeout: Optional[float], budget: Optional[Budget]
+                   ) -> str:
+        if timeout is _DEFAULT_TIMEOUT:
+            timeout = self.timeout
+        if budget is _DEFAULT_BUDGET:
+            budget = self.budget
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = \
+                asyncio.Semaphore(self.max_pending)
+        await semaphore.acquire()
+        try:
+            future = self._executor.submit(function, argument, self._config,
+                                           budget)
+        except BaseException:
+            semaphore.release()
+            raise
+        # The slot is only given back once the executor is done with
+        # the call, even if it is no longer awaited.
+        future.add_done_callback(
+            functools.partial(_release_threadsafe, loop, semaphore))
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+
+    async def normalize(self, text: str,
+                        timeout: Optional[float] = _DEFAULT_TIMEOUT,
+                        budget: Optional[Budget] = _DEFAULT_BUDGET) -> str:
+        '''
+        Normalize text, as latex_normalizer does.
+        '''
+        return await self._run(_normalize_with_config, text, timeout,
+                               budget)
+
+    async def normalize_file(self, path: str,
+                             timeout: Optional[float] = _DEFAULT_TIMEOUT,
+                             budget: Optional[Budget] = _DEFAULT_BUDGET
+                             ) -> str:
+        '''
+        Normalize the file at path. The file is read by the executor as
+        well, in chunks.
+        '''
+        return await self._run(_normalize_file_with_config, path, timeout,
+                               budget)
+
+
+@functools.lru_cache(maxsize=None)
+def _configured_normalizer(config: NormalizerConfig) -> Normalizer:
+    if config == _DEFAULT_NORMALIZER.config:
+        return _DEFAULT_NORMALIZER
+    return Normalizer(config)
+
+
+def _normalize_with_config(text: str, config: NormalizerConfig,
+                           budget: Optional[Budget] = None) -> str:
+    return _configured_normalizer(config)(text, budget=budget)
+
+
+def _normalize_file_with_config(path: str, config: NormalizerConfig,
+                                budget: Optional[Budget] = None) -> str:
+    return _normalize_file_contents(path, _configured_normalizer(config),
+                                    budget=budget)
+
+
+def _normalize_part(part: str, offset: int, last: bool,
+                    config: NormalizerConfig,
+                    budget: Optional[Budget] = None,
+                    deadline: Optional[float] = None,
+                    report: bool = False
+                    ) -> Tuple[Optional[str], List[Diagnostic]]:
+    '''
+    Normalize a part of a text starting at offset for
+    Normalizer.normalize_parallel, as the start of the rest of the text
+    unless it is the last part, see Normalizer._stream_part. The
+    diagnostics are returned with the normalization if report is set,
+    as on_error cannot be called from another process.
+    '''
+    diagnostics: List[Diagnostic] = []
+    normalized = _configured_normalizer(config)._stream_part(
+        part, last, offset, diagnostics.append if report else None, budget,
+        deadline)
+    return normalized, diagnostics
+
+
+# The AsyncNormalizer used by anormalize and anormalize_file, created
+# when first needed.
+_DEFAULT_ASYNC_NORMALIZER: Optional[AsyncNormalizer] = None
+
+
+def _default_async_normalizer() -> AsyncNormalizer:
+    global _DEFAULT_ASYNC_NORMALIZER
+    if _DEFAULT_ASYNC_NORMALIZER is None:
+        _DEFAULT_ASYNC_NORMALIZER = AsyncNormalizer()
+    return _DEFAULT_ASYNC_NORMALIZER
+
+
+async def anormalize(text: str,
+                     timeout: Optional[float] = _DEFAULT_TIMEOUT,
+                     budget: Optional[Budget] = _DEFAULT_BUDGET) -> str:
+    '''
+    Normalize text in a process pool shared by all callers, see
+    AsyncNormalizer.
+    '''
+    return await _default_async_normalizer().normalize(text, timeout,
+                                                       budget)
+
+
+async def anormalize_file(path: str,
+                          timeout: Optional[float] = _DEFAULT_TIMEOUT,
+                          budget: Optional[Budget] = _DEFAULT_BUDGET
+                          ) -> str:
+    '''
+    Normalize the file at path in a process pool shared by all callers,
+    see AsyncNormalizer.
+    '''
+    return await _default_async_normalizer().normalize_file(path, timeout,
+                                                            budget)
+
+
+def matching_paren_pos(text: str, start: int = 0, open_paren: str = '{',
+                       close_paren: str = '}') -> int:
+    r'''
+    Find the position in text of the parenthesis closing the one at
+    position start.
+
+    Only the parentheses are looked at, so the text is not copied, and
+    the text in between is skipped in one go.
+
+    >>> matching_paren_pos('{{a}{}}b')
     6
 
-    >>> _matching_paren_pos('a')
+    >>> matching_paren_pos('a{b}[c]', 4, '[', ']')
+    6
+
+    >>> matching_paren_pos('a')
     Traceback (most recent call last):
         ...
     Exception: leading character (a) should be {
 
-    >>> _matching_paren_pos('{{}')
+    >>> matching_paren_pos('{{}')
     Traceback (most recent call last):
         ...
     Exception: unmatched parenthesis
     '''
-    if string[0] != open_paren:
-        raise Exception(f'leading character ({string[0]}) '
+    if text[start] != open_paren:
+        raise Exception(f'leading character ({text[start]}) '
                         f'should be {open_paren}')
 
-    # Iterating over the string, put the opening brackets encountered
-    # in a stack, and pop it every time a closing bracket occurs.
-    # When the stack is empty, return the position.
-    open_parens = []
-    for pos, char in enumerate(string):
-        if char == open_paren:
-            open_parens.append(char)
-        elif char == close_paren:
-            open_parens.pop()
-            if not open_parens:
-                return pos
+    # Count the depth of the parentheses encountered, and return the
+    # position when it drops back to zero.
+    depth = 0
+    for match in _paren_regex(open_paren, close_paren).finditer(text, start):
+        if match.group() == open_paren:
+            depth += 1
+        else:
+            depth -= 1
+            if not depth:
+                return match.start()
     raise Exception('unmatched parenthesis')
 
 
-def _matching_brackets_digram(text: str, open_bracket: str = r'\(',
-                              close_bracket: str = r'\)'
-                              ) -> List[Tuple[int, int]]:
+def paren_pairs(text: str, open_paren: str = '{',
+                close_paren: str = '}') -> Dict[int, int]:
+    r'''
+    Find the positions of all matching parentheses in text in one go.
+
+    Returns a dictionary mapping the position of every opening
+    parenthesis that is matched to the position of the parenthesis
+    closing it, which is what matching_paren_pos would return for it.
+
+    >>> paren_pairs('{{a}{}}b}{')
+    {1: 3, 4: 5, 0: 6}
+
+    >>> paren_pairs('[a]{[b]}', '[', ']')
+    {0: 2, 4: 6}
+    '''
+    pairs = {}
+    open_positions = []
+    for match in _paren_regex(open_paren, close_paren).finditer(text):
+        if match.group() == open_paren:
+            open_positions.append(match.start())
+        elif open_positions:
+            pairs[open_positions.pop()] = match.start()
+    return pairs
+
+
+def _bracket_depth(text: str, open_paren: str = '{',
+                   close_paren: str = '}') -> int:
+    '''
+    Return the greatest nesting depth of the parentheses in text, the
+    closing parentheses left unmatched being skipped.
+
+    >>> _bracket_depth('{{a}{}}}{{')
+    2
+    '''
+    depth = 0
+    max_depth = 0
+    for match in _paren_regex(open_paren, close_paren).finditer(text):
+        if match.group() == open_paren:
+            depth += 1
+            max_depth = max(max_depth, depth)
+        elif depth:
+            depth -= 1
+    return max_depth
+
+
+@functools.lru_cache(maxsize=None)
+def _paren_regex(open_paren: str, close_paren: str) -> Pattern:
+    '''
+    Regex matching the given opening and closing parentheses.
+    '''
+    return re.compile(re.escape(open_paren) + '|' + re.escape(close_paren))
+
+
+# Matches the delimiters of equations \( \[ \) \], one group for each.
+_BRACKET_DELIMITER_REGEX = re.compile(r'\\(?:(\()|(\[)|(\))|(\]))')
+
+
+def _bracket_equation_intervals(text: str) -> array:
+    r'''
+    Match the delimiters \( \) and \[ \] in a string, and return the
+    intervals from every opening delimiter to the end of its closing
+    delimiter, as a flat array of starts and ends. Both kinds of
+    delimiters are matched independently of each other.
+
+    >>> list(_bracket_equation_intervals('abcd'))
+    []
+
+    >>> list(_bracket_equation_intervals(r'\( \)'))
+    [0, 4]
+
+    >>> list(_bracket_equation_intervals(r'\(\(\)\)'))
+    [2, 5, 0, 7]
+
+    >>> list(_bracket_equation_intervals(r'\[\(\]\)'))
+    [0, 5, 2, 7]
+
+    >>> _bracket_equation_intervals(r'\(\(\(\)')
+    Traceback (most recent call last):
+        ...
+    Exception: brackets are unbalanced
+
+    >>> _bracket_equation_intervals(r'\(')
+    Traceback (most recent call last):
+        ...
+    Exception: brackets are unbalanced
+
+    >>> _bracket_equation_intervals(r'\)')
+    Traceback (most recent call last):
+        ...
+    Exception: brackets are unbalanced
+    '''
+    # The positions of the open \( and of the open \[ delimiters.
+    open_positions: Tuple[List[int], List[int]] = ([], [])
+    intervals = array('l')
+    # Two delimiters can not overlap, so the regex finds all of them.
+    for match in _BRACKET_DELIMITER_REGEX.finditer(text):
+        group, position = match.lastindex, match.start()
+        positions = open_positions[(group - 1) % 2]
+        if group <= 2:
+            positions.append(position)
+        elif positions:
+            # Include both characters of the closing delimiter.
+            intervals.append(positions.pop())
+            intervals.append(position + 1)
+        else:
+            raise Exception('brackets are unbalanced')
+    if any(open_positions):
+        raise Exception('brackets are unbalanced')
+    return intervals
+
+
+def _excise_intervals(text: str,
+                      intervals: Iterable[Tuple[int, int]]) -> str:
+    r'''
+    Takes a string and a list of intervals, and returns the string with
+    these intervals replaced by single white spaces.
+
+    >>> _excise_intervals('hey', [])
+    'hey'
+
+    >>> _excise_intervals('Remove this and nothing else', [(7, 10)])
+    'Remove   and nothing else'
+
+    >>> _excise_intervals('Remove this and nothing else', [(7, 8), (9, 10)])
+    'Remove    and nothing else'
+
+    >>> _excise_intervals('Remove this and nothing else', [(7, 10), (8, 9)])
+    'Remove   and nothing else'
+
+    >>> _excise_intervals('Remove this and nothing else', [(7, 9), (8, 10)])
+    Traceback (most recent call last):
+        ...
+    Exception: non-trivially overlapping intervals
+
+    >>> _excise_intervals('hey', [(3, 4)])
+    Traceback (most recent call last):
+        ...
+    Exception: interval out of bounds
+
+    >>> _excise_intervals('hey', [(2, 3)])
+    Traceback (most recent call last):
+        ...
+    Exception: interval out of bounds
+
+    >>> _excise_intervals('hey', [(2, 1)])
+    Traceback (most recent call last):
+        ...
+    Exception: interval out of order
+    '''
+    # Go through the intervals in order, keeping the ones that are
+    # not contained in an earlier one. These are disjoint, and sorted.
+    starts = []
+    ends = []
+    for start, end in sorted(intervals):
+        if starts and start <= ends[-1]:
+            # The interval starts inside the last interval kept, so it
+            # has to end inside one of the intervals kept as well.
+            position = bisect.bisect_right(starts, end) - 1
+            if position < 0 or end > ends[position]:
+                raise Exception('non-trivially overlapping intervals')
+        elif end < start:
+            raise Exception('interval out of order')
+        else:
+            starts.append(start)
+            ends.append(end)
+    if ends and ends[-1] > len(text) - 1:
+        raise Exception('interval out of bounds')
+
+    # Replace every interval kept by a single space.
+    pieces = []
+    position = 0
+    for start, end in zip(starts, ends):
+        pieces.append(text[position:start])
+        pieces.append(' ')
+        position = end + 1
+    pieces.append(text[position:])
+    return ''.join(pieces)
+
+
+def _remove_line_comments(text: str,
+                          normalizer: Normalizer = _DEFAULT_NORMALIZER) -> str:
+    r'''
+    Remove line comments from latex code.
+
+    Specifically, this takes all text between % and the next newline,
+    and replaces it with a single space. This is not done if the percent
+    symbol is preceded by an odd number of back slashes. This is because
+    for example "\\\% " is not ignored by the latex compiler. It prints
+    a percent symbol on a new line.
+
+    >>> _remove_line_comments('Hi, I do not contain any comments. \n')
+    'Hi, I do not contain any comments. \n'
+
+    >>> _remove_line_comments('Hi, I do. %comment\nNext line.')
+    'Hi, I do.  Next line.'
+
+    >>> _remove_line_comments('Me too. \\\\% comment\n')
+    'Me too. \\\\ '
+
+    >>> _remove_line_comments('0\\%\n')
+    '0\\%\n'
+    '''
+    # No comment starts on the last line, which has no newline. Leaving
+    # it out keeps every percent sign on it from scanning to its end.
+    end = text.rfind('\n') + 1
+    return normalizer._line_comment_regex.sub(r'\1 ', text[:end]) \
+        + text[end:]
+
+
+def _remove_accents(text: str,
+                    normalizer: Normalizer = _DEFAULT_NORMALIZER) -> str:
+    r'''
+    Replace latex code for diacritics with the empty string.
+
+    Replace letters with diacritics by their non-diacritical
+    counterpart. For example, hyperk\"ahler becomes hyperkahler.
+    Moreover, hyperk\"{a}hler becomes hyperkahler too.
+
+    >>> _remove_accents('Nothing happens to me')
+    'Nothing happens to me'
+
+    >>> _remove_accents('hyperk\\"ahler is hyperk\\"{a}hler')
+    'hyperkahler is hyperkahler'
+
+    >>> _remove_accents('\\c Ca va? \\c{C}a va')
+    'Ca va? Ca va'
+
+    If the normalizer keeps Unicode, the accented letters are kept.
+
+    >>> unicode = Normalizer(NormalizerConfig(keep_unicode=True))
+    >>> _remove_accents('G\\"odel, \\c{c}a, \\c ca', unicode)
+    'Gödel, ça, ça'
+    '''
+    if normalizer.config.keep_unicode:
+        output = normalizer._letter_accent_regex.sub(normalizer._accented,
+                                                     text)
+        return normalizer._non_letter_accent_regex.sub(
+            normalizer._accented, output)
+    output = normalizer._letter_accent_regex.sub(r'\1', text)
+    output = normalizer._non_letter_accent_regex.sub(r'\1', output)
+    return output
+
+
+def _normalize_commands(text: str,
+                        normalizer: Normalizer = _DEFAULT_NORMALIZER) -> str:
+    r'''
+    Replace a list of specified latex commands with their arguments.
+
+    More concretely, this function replaces "\command{argument}" with
+    " argument ", where command is a command from the list
+        subsubsection,
+        subsection,
+        section,
+        chapter,
+        title,
+        author,
+        footnote,
+        emph,
+        text,
+        textit,
+        textrm.
+    If no argument is passed to the command, the command is replaced
+    with an empty string.
+
+    >>> _normalize_commands('\shouldnt{change}')
+    '\\shouldnt{change}'
+
+    >>> _normalize_commands('\chapter{On{e}')
+    ' On{e}'
+
+    >>> _normalize_commands('\chapter{Hyperk\\"{a}hlers}')
+    ' Hyperk\\"{a}hlers '
+
+    >>> _normalize_commands('\chapter{One} \section{two}')
+    ' One   two '
+
+    >>> _normalize_commands('\sectionheader')
+    '\\sectionheader'
+    '''
+    pairs = paren_pairs(text)
+    # Collect the positions of the brackets to replace by a space.
+    replaced = []
+    for match in normalizer._normalized_command_regex.finditer(text):
+        _, open_pos = match.span()
+        replaced.append(open_pos)
+        # If the bracket at the end of the command is matched, replace
+        # the closing bracket as well. Replacing earlier brackets does
+        # not change which brackets match later on, as they are
+        # replaced in pairs, or are not matched at all.
+        if open_pos in pairs:
+            replaced.append(pairs[open_pos])
+    if replaced:
+        pieces = []
+        position = 0
+        for replaced_pos in sorted(replaced):
+            pieces.append(text[position:replaced_pos])
+            pieces.append(' ')
+            position = replaced_pos + 1
+        pieces.append(text[position:])
+        text = ''.join(pieces)
+
+    return normalizer._spaced_normalized_command_regex.sub('', text)
+
+
+def _remove_environments(text: str,
+                         normalizer: Normalizer = _DEFAULT_NORMALIZER) -> str:
+    r'''
+    Remove a specified list of latex environments, and the delimiters
+    of the other environments and labels.
+
+    Specifically, replace "\begin{environment} contents
+    \end{environment}" with the empty string, where environment is
+    an environment on the list
+        comment,
+        figure,
+        tikzpicture,
+        equation(*),
+        multline(*),
+        align(*),
+        gather(*),
+    and replace every other \begin{...}, \end{...} and \label{...} by a
+    space. The delimiters are found in a single pass, and the removed
+    environments are matched as in _environment_spans, so nested
+    environments are removed as a whole.
+
+    >>> _remove_environments('a\\begin{figure}\\begin{figure}'
+    ...                      '\\end{figure}\\end{figure}b')
+    'ab'
+
+    >>> _remove_environments('a\\begin{itemize}\\label{x}b\\end{figure}')
+    'a  b '
+    '''
+    delimiters = list(_environment_delimiters(text, normalizer))
+    spans, _ = _environment_spans(delimiters, normalizer)
+    pieces = []
+    position = 0
+    span_index = 0
+    for _, _, start, end in delimiters:
+        if start < position:
+            # Inside a removed environment.
+            continue
+        pieces.append(text[position:start])
+        if span_index < len(spans) and spans[span_index][0] == start:
+            position = spans[span_index][1]
+            span_index += 1
+        else:
+            pieces.append(' ')
+            position = end
+    pieces.append(text[position:])
+    return ''.join(pieces)
+
+
+_CLOSE_BRACKET_OR_NEWLINE_REGEX = re.compile('[}\n]')
+
+
+def _environment_delimiters(text: str,
+                            normalizer: Normalizer = _DEFAULT_NORMALIZER
+                            ) -> Iterator[Tuple[str, str, int, int]]:
+    r'''
+    Yield the \begin, \end and \label delimiters in text, as (kind,
+    name, start, end).
+
+    The argument of a delimiter runs to the first closing bracket, which
+    has to be on the same line. That bracket is searched for once for
+    all the delimiters before it, so that many delimiters left open on
+    a line take linear time.
+
+    >>> list(_environment_delimiters('\\label{\\label{a}\\end{\n}'))
+    [('label', '\\label{a', 0, 16)]
+    '''
+    # The first closing bracket or newline after the last argument
+    # searched, which is also the first one after the later arguments
+    # starting before it.
+    stop = -1
+    position = 0
+    for match in normalizer._environment_label_regex.finditer(text):
+        start, argument_start = match.span()
+        if start < position:
+            # Inside the argument of the last delimiter.
+            continue
+        if stop < argument_start:
+            stop_match = _CLOSE_BRACKET_OR_NEWLINE_REGEX.search(
+                text, argument_start)
+            stop = stop_match.start() if stop_match else len(text)
+        if text[stop:stop + 1] != '}':
+            continue
+        yield match.group(1), text[argument_start:stop], start, stop + 1
+        position = stop + 1
+
+
+def _environment_spans(delimiters: Iterable[Tuple[str, str, int, int]],
+                       normalizer: Normalizer = _DEFAULT_NORMALIZER
+                       ) -> Tuple[List[Tuple[int, int]], bool]:
+    r'''
+    Match the delimiters of the removed environments among delimiters,
+    given as (kind, name, start, end), where kind is begin, end or
+    label.
+
+    Every \end closes the last \begin of the same environment still
+    open, as a stack. Returns the spans from the start of every
+    matched \begin to the end of its \end, the spans inside or
+    overlapping others being merged into them, in order. Also returns
+    whether every \begin is closed.
+
+    >>> _environment_spans([('begin', 'figure', 0, 1),
+    ...                     ('begin', 'comment', 1, 2),
+    ...                     ('end', 'figure', 2, 3),
+    ...                     ('end', 'comment', 3, 4),
+    ...                     ('begin', 'figure', 4, 5)])
+    ([(0, 4)], False)
+    '''
+    name_regex = normalizer._environment_name_regex
+    open_starts: Dict[str, List[int]] = {}
+    pairs = []
+    for kind, name, start, end in delimiters:
+        if kind == 'label' or not name_regex.fullmatch(name):
+            continue
+        if kind == 'begin':
+            open_starts.setdefault(name, []).append(start)
+        elif open_starts.get(name):
+            pairs.append((open_starts[name].pop(), end))
+    pairs.sort()
+    spans: List[Tuple[int, int]] = []
+    for start, end in pairs:
+        if spans and start < spans[-1][1]:
+            if end > spans[-1][1]:
+                spans[-1] = (spans[-1][0], end)
+        else:
+            spans.append((start, end))
+    return spans, not any(open_starts.values())
+
+
+def _remove_commands(text: str,
+                     normalizer: Normalizer = _DEFAULT_NORMALIZER) -> str:
+    r'''
+    Remove entire commands.
+
+    More concretely, this remove all commands and their arguments
+    (optional or otherwise). That is, "\a*{b}[c]{d}$ is replaced with
+    a single space.
+
+    >>> _remove_commands('abc')
+    'abc'
+
+    >>> _remove_commands('\command*{baba}[caba]{daba}a')
+    ' a'
+
+    >>> _remove_commands('\command')
+    ' '
+
+    >>> _remove_commands('\command[option]')
+    ' '
+
+    >>> _remove_commands('\command{argument')
+    ' argument'
+
+    >>> _remove_commands('a \command and \\another{one}')
+    'a   and  '
+
+    >>> _remove_commands('\@command')
+    ' '
+    '''
+    # The values and keys of this dictionary are the brackets enclosing
+    # the arguments of a command.
+    paren_dict = {
+            '{': '}',
+            '[': ']',
+            }
+    pairs = {
+            open_paren: paren_pairs(text, open_paren, close_paren)
+            for open_paren, close_paren in paren_dict.items()
+            }
+    # Walk through the text with a cursor, collecting the text between
+    # the commands in pieces.
+    pieces = []
+    position = 0
+    length = len(text)
+    while True:
+        # Find the next command, and replace it by a space. Should only
+        # look for one command at a time, because input like
+        # "\command{\command}" is possible.
+        match = normalizer._command_regex.search(text, position)
+        if match is None:
+            pieces.append(text[position:])
+            break
+        pieces.append(text[position:match.start()])
+        pieces.append(' ')
+        position = match.end()
+        # Iteratively skip everything between consecutive brackets
+        # following the command.
+        while position < length and text[position] in paren_dict:
+            close_pos = pairs[text[position]].get(position)
+            # If the opening bracket is unmatched, we only skip the
+            # opening bracket, and go back to searching for a command.
+            if close_pos is None:
+                position += 1
+                break
+            position = close_pos + 1
+    return ''.join(pieces)
+
+
+def _remove_bracket_equations(text: str) -> str:
+    r'''
+    Remove inline and display equations delimited by \( and \[.
+
+    >>> _remove_bracket_equations('abc')
+    'abc'
+
+    >>> _remove_bracket_equations(r'These too: \(1 + 1\)')
+    'These too:  '
+
+    >>> _remove_bracket_equations(r'This is an equation: \[1 + 1 = \$\]')
+    'This is an equation:  '
+
+    >>> _remove_bracket_equations(r'This is not: \(1 \[+\] 1\)')
+    'This is not:  '
+
+    >>> _remove_bracket_equations(r'This is not: \[1 \(+\) 1\]')
+    'This is not:  '
+    '''
+    intervals = _bracket_equation_intervals(text)
+    return _excise_intervals(text, zip(intervals[::2], intervals[1::2]))
+
+
+def _remove_dollar_equations(
+        text: str,
+        normalizer: Normalizer = _DEFAULT_NORMALIZER
+        ) -> str:
+    r'''
+    Remove inline and display equations delimited by $ or $$.
+
+    >>> _remove_dollar_equations(r'No equation, \$3.50, \$2')
+    'No equation, \\$3.50, \\$2'
+
+    >>> _remove_dollar_equations('An equation $1 + 1\$$ should go')
+    'An equation   should go'
+
+    >>> _remove_dollar_equations('Display equations $$\n 1 + 1 \n $$ too')
+    'Display equations   too'
+
+    >>> _remove_dollar_equations('$ back $$ to $$ back $')
+    '   '
+
+    >>> _remove_dollar_equations('$$ $$$$ $$')
+    '  '
+
+    >>> _remove_dollar_equations(r'$$ \text{$nested$} $$')
+    Traceback (most recent call last):
+        ...
+    Exception: LaTeX syntax error
+
+    >>> _remove_dollar_equations('$ back $$$ to back $$')
+    '  '
+    '''
+    remover = _DollarEquationRemover(normalizer)
+    return remover.feed(text) + remover.close()
+
+
+class _DollarMatcher:
+    '''
+    Matches runs of dollar signs into equations, from left to right.
+
+    A run first closes the open equation, if any, and the remaining
+    dollar signs open a new one. This matches the same equations as
+    matching the runs from right to left, each run closing the equation
+    opened by the last dollar signs of the run before it.
+    '''
+
+    def __init__(self) -> None:
+        # The number of dollar signs that opened the open equation, or
+        # 0 if there is none.
+        self.delimiter = 0
+
+    def match(self, length: int) -> int:
+        '''
+        Match a run of length dollar signs, and return how many of them
+        close the open equation.
+        '''
+        closing = self.delimiter
+        if length < closing or length - closing == 3:
+            raise Exception('LaTeX syntax error')
+        self.delimiter = length - closing
+        return closing
+
+    def close(self) -> None:
+        '''
+        Check that no equation is left open at the end of the text.
+        '''
+        if self.delimiter:
+            raise Exception('LaTeX syntax error')
+
+
+class _DollarEquationRemover:
+    r'''
+    Removes the equations delimited by dollar signs from a text that is
+    fed to it in chunks, as _remove_dollar_equations does.
+
+    Every chunk is scanned once, and the text outside of equations is
+    returned right away. Every equation is replaced by a space once it
+    is closed.
+
+    >>> remover = _DollarEquationRemover()
+    >>> [remover.feed('a $b'), remover.feed('$ c $'), remover.feed('$d$$ e')]
+    ['a ', '  c ', '  e']
+    >>> remover.in_equation
+    False
+    >>> remover.close()
+    ''
+    '''
+
+    def __init__(self, normalizer: Normalizer = _DEFAULT_NORMALIZER) -> None:
+        self._run_regex = normalizer._dollar_run_regex
+        self._matcher = _DollarMatcher()
+        # The end of the previous chunk, if it could be continued by
+        # the next one.
+        self._pending = ''
+
+    @property
+    def in_equation(self) -> bool:
+        return bool(self._matcher.delimiter)
+
+    def feed(self, text: str) -> str:
+        '''
+        Remove the equations from the next chunk of text.
+        '''
+        text = self._pending + text
+        # Dollar signs and backslashes at the end of the chunk can be
+        # part of the same run as the start of the next one.
+        end = len(text)
+        while end and text[end - 1] in '\\$':
+            end -= 1
+        self._pending = text[end:]
+        return self._scan(text, end)
+
+    def close(self) -> str:
+        '''
+        Remove the equations from what is left of the text, and check
+        that all equations are closed.
+        '''
+        text, self._pending = self._pending, ''
+        output = self._scan(text, len(text))
+        self._matcher.close()
+        return output
+
+    def _scan(self, text: str, end: int) -> str:
+        pieces = []
+        position = 0
+        for match in self._run_regex.finditer(text, 0, end):
+            # Up to 4 dollar signs in a row are allowed, 5 if the first
+            # is preceded by an odd number of backslashes (compiling to
+            # a bunch of line breaks and a dollar sign).
+            if len(match.group(1)) > 4:
+                raise Exception('LaTeX syntax error')
+            start, run_end = match.span()
+            if not self._matcher.delimiter:
+                pieces.append(text[position:start])
+            # The run includes the escaped backslashes preceding it.
+            if self._matcher.match(run_end - start):
+                pieces.append(' ')
+            position = run_end
+        if not self._matcher.delimiter:
+            pieces.append(text[position:end])
+        return ''.join(pieces)
+
+
+def _remove_equations(text: str,
+                      normalizer: Normalizer = _DEFAULT_NORMALIZER) -> str:
+    r'''
+    Remove inline and display equations.
+
+    Removes inline equations delimited by $ and \(, and removes display
+    equations delimited by $$ and \[. Ignores dollar signs preceded by
+    a single backslash, as the latex compiler renders that as a dollar
+    sign.
+
+    >>> _remove_equations(r'No equation, \$3.50, \$2')
+    'No equation, \\$3.50, \\$2'
+
+    >>> _remove_equations('An equation $1 + 1\$$ should go')
+    'An equation   should go'
+
+    >>> _remove_equations('Display equations $$\n 1 + 1 \n $$ too')
+    'Display equations   too'
+
+    >>> _remove_equations(r'These too: \(1 + 1\)')
+    'These too:  '
+
+    >>> _remove_equations(r'This is an actual equation: \[1 + 1 = \$\]')
+    'This is an actual equation:  '
+
+    >>> _remove_equations('$ back $$ to $$ back $')
+    '   '
+
+    >>> _remove_equations(r'$$ \text{$nested$} $$')
+    Traceback (most recent call last):
+        ...
+    Exception: LaTeX syntax error
+
+    >>> _remove_equations('$ back $$$ to back $$')
+    '  '
+    '''
+    text = _remove_dollar_equations(text, normalizer)
+    text = _remove_bracket_equations(text)
+    return text
+
+
+# Translation tables mapping every character but the letters to a
+# space. Characters outside of ASCII are first encoded as question marks,
+# unless Unicode is kept.
+_ASCII_LETTER_TABLE = bytes(
+    code if chr(code).isalpha() and code < 128 else ord(' ')
+    for code in range(256))
+
+
+class _UnicodeLetterTable(dict):
+    '''
+    A translation table for str.translate keeping the letters of every
+    alphabet and the combining marks, and mapping every other character
+    to a space. The characters are classified as they are first looked
+    up.
+    '''
+
+    def __missing__(self, code: int) -> int:
+        character = chr(code)
+        kept = character.isalpha() or \
+            unicodedata.category(character).startswith('M')
+        self[code] = code if kept else ord(' ')
+        return self[code]
+
+
+_UNICODE_LETTER_TABLE = _UnicodeLetterTable()
+_NON_SPACE_REGEX = re.compile('[^ ]+')
+
+
+def _remove_special_characters(
+        text: str,
+        normalizer: Normalizer = _DEFAULT_NORMALIZER
+        ) -> str:
+    r'''
+    Replace characters that are not letters by a space, and then every
+    run of white space by a single space, trimming the ends.
+
+    Both are done with a translation table and a single split, instead
+    of with a regex.
+
+    >>> _remove_special_characters(' G\xf6del,\n\tGodel \u0131 ')
+    'G del Godel'
+    >>> _remove_special_characters(
+    ...     ' G\xf6del,\n\tGodel \u0131 ',
+    ...     Normalizer(NormalizerConfig(keep_unicode=True))
+    ...     ) == 'G\xf6del Godel \u0131'
+    True
+    '''
+    if normalizer.config.keep_unicode:
+        return ' '.join(text.translate(_UNICODE_LETTER_TABLE).split())
+    return b' '.join(text.encode('ascii', 'replace').translate(
+        _ASCII_LETTER_TABLE).split()).decode('ascii')
+
+
+def _normalize_closed(text: str,
+                      normalizer: Normalizer = _DEFAULT_NORMALIZER,
+                      deadline: Optional[float] = None) -> Optional[str]:
+    r'''
+    Normalize text ending in a blank line, as the start of a longer text.
+
+    Returns None if a group, environment or equation is still open at
+    the end of text, since its normalization could then depend on the
+    text following it. Otherwise, the normalization of any text
+    starting with text is the result, followed by a space and the
+    normalization of the rest.
+
+    If a stage ends past the time.perf_counter deadline,
+    _BudgetExceeded is raised, as in Normalizer._call_within_budget.
+
+    >>> _normalize_closed('\\emph{Hi} $x$\n\n')
+    'Hi'
+
+    >>> _normalize_closed('\\emph{Hi} $x\n\n') is None
+    True
+
+    >>> _normalize_closed('\\begin{figure}\n\n') is None
+    True
+    '''
+    def check(stage: str) -> None:
+        if deadline is not None and time.perf_counter() > deadline:
+            raise _BudgetExceeded('seconds', stage)
+
+    text = _remove_line_comments(text, normalizer)
+    check('_remove_line_comments')
+    text = _remove_accents(text, normalizer)
+    check('_remove_accents')
+    if not _arguments_matched(text, normalizer._normalized_command_regex):
+        return None
+    text = _normalize_commands(text, normalizer)
+    check('_normalize_commands')
+    if not _environments_closed(text, normalizer):
+        return None
+    text = _remove_environments(text, normalizer)
+    check('_remove_environments')
+    if not _arguments_matched(text, normalizer._command_regex):
+        return None
+    text = _remove_commands(text, normalizer)
+    check('_remove_commands')
+    # A syntax error in the equations is raised right away, as
+    # normalizing the whole text raises it as well.
+    remover = _DollarEquationRemover(normalizer)
+    text = remover.feed(text)
+    if remover.in_equation:
+        return None
+    text += remover.close()
+    check('_remove_dollar_equations')
+    text = _remove_bracket_equations(text)
+    check('_remove_bracket_equations')
+    text = _remove_special_characters(text, normalizer)
+    check('_remove_special_characters')
+    return text
+
+
+def _arguments_matched(text: str, command_regex: Pattern) -> bool:
+    r'''
+    Check if all brackets directly following a command are matched.
+
+    >>> _arguments_matched('\\a{b}[c]', re.compile(r'\\\w*'))
+    True
+
+    >>> _arguments_matched('\\a{b}[c', re.compile(r'\\\w*'))
+    False
+    '''
+    return all(close_pos is not None for _, close_pos
+               in _argument_brackets(text, command_regex))
+
+
+def _argument_brackets(text: str, command_regex: Pattern
+                       ) -> Iterator[Tuple[int, Optional[int]]]:
+    r'''
+    Find the brackets directly following the commands in text.
+
+    Yields the position of every such opening bracket, and that of the
+    bracket closing it, or None if it is unmatched. The brackets
+    following an unmatched one are not considered.
+
+    >>> list(_argument_brackets('\\a{b}[c', re.compile(r'\\\w*')))
+    [(2, 4), (5, None)]
+    '''
+    paren_dict = {
+            '{': '}',
+            '[': ']',
+            }
+    # The brackets are only matched once a command is followed by one.
+    pairs: Dict[str, Dict[int, int]] = {}
+    length = len(text)
+    for match in command_regex.finditer(text):
+        position = match.end()
+        while position < length and text[position] in paren_dict:
+            open_paren = text[position]
+            if open_paren not in pairs:
+                pairs[open_paren] = paren_pairs(text, open_paren,
+                                                paren_dict[open_paren])
+            close_pos = pairs[open_paren].get(position)
+            yield position, close_pos
+            if close_pos is None:
+                break
+            position = close_pos + 1
+
+
+def _environments_closed(text: str,
+                         normalizer: Normalizer = _DEFAULT_NORMALIZER
+                         ) -> bool:
+    r'''
+    Check if every removed environment opened in text is also closed.
+
+    >>> _environments_closed('\\begin{figure}a\\end{figure}')
+    True
+
+    >>> _environments_closed('\\begin{figure}a\\end{comment}')
+    False
+    '''
+    _, closed = _environment_spans(_environment_delimiters(text, normalizer),
+                                   normalizer)
+    return closed
+
+
+_BLANK_LINE_REGEX = re.compile('\n\n')
+# The size of the parts normalized at a time while recovering from
+# errors, before the part with an error is narrowed down.
+_RECOVERY_PART_SIZE = 2**16
+
+
+def _normalize_recovering(text: str, on_error: Callable[[Diagnostic], None],
+                          normalizer: Normalizer = _DEFAULT_NORMALIZER,
+                          offset: int = 0,
+                          deadline: Optional[float] = None
+                          ) -> Iterator[str]:
+    r'''
+    Normalize text paragraph by paragraph, dropping the paragraphs that
+    cause errors.
+
+    Consecutive paragraphs are normalized together for as long as a
+    group, environment or equation is open, see _closed_runs. If such
+    a part raises an error, or is still open at the end of text, its
+    first paragraph is dropped, on_error is called with a Diagnostic,
+    and normalizing resumes at the next paragraph. The offsets of the
+    diagnostics are counted from offset.
+
+    To save time, the text is normalized in parts of about
+    _RECOVERY_PART_SIZE characters. A part that fails is normalized
+    again paragraph by paragraph, and the size of the parts doubles
+    again from a single paragraph after every part that succeeds, so
+    that every error costs time linear in the size of the part it was
+    found in. Likewise, the paragraphs following the first one of a
+    part that fails after being left open are normalized on their own,
+    each as the end of the text, rather than every one of them being
+    normalized with the rest of the part again. If a stage ends past
+    the time.perf_counter deadline, _BudgetExceeded is raised.
+
+    >>> diagnostics = []
+    >>> list(_normalize_recovering('a $b\n\nc $d$\n\ne', diagnostics.append))
+    ['c', 'e']
+    >>> diagnostics[0].offset, diagnostics[0].length, diagnostics[0].kind
+    (0, 6, 'LaTeX syntax error')
+
+    Many errors take time linear in the size of the text.
+
+    >>> diagnostics = []
+    >>> start = time.perf_counter()
+    >>> ' '.join(_normalize_recovering('a $$$ b\n\n' * 20000 + 'c $d$',
+    ...                                diagnostics.append))
+    'c'
+    >>> len(diagnostics), time.perf_counter() - start < 10
+    (20000, True)
+
+    So do many paragraphs left open, followed by an error.
+
+    >>> diagnostics = []
+    >>> start = time.perf_counter()
+    >>> ' '.join(_normalize_recovering('\\a{\n\n' * 8000 + 'b $',
+    ...                                diagnostics.append))
+    ''
+    >>> [(diagnostic.offset, diagnostic.length)
+    ...  for diagnostic in diagnostics], time.perf_counter() - start < 10
+    ([(0, 5), (40000, 3)], True)
+    '''
+    boundaries = [match.end() for match in _BLANK_LINE_REGEX.finditer(text)]
+    if not boundaries or boundaries[-1] < len(text):
+        boundaries.append(len(text))
+    start = 0
+    # The index in boundaries of the end of the first paragraph of the
+    # part being normalized.
+    first = 0
+    # The size of the next part, 0 for a single paragraph.
+    part_size = _RECOVERY_PART_SIZE
+    # The last part normalized, which raised if normalizing failed.
+    attempted = ''
+    # The end of the part that failed after being left open, up to
+    # which the paragraphs are normalized on their own.
+    isolated_end = 0
+
+    def normalize(part: str, part_start: int, last: bool) -> Optional[str]:
+        nonlocal attempted
+        attempted = part
+        if deadline is not None and time.perf_counter() > deadline:
+            raise _BudgetExceeded('seconds', '_normalize_recovering')
+        if last:
+            if deadline is None:
+                return normalizer(part)
+            return normalizer._call_within_budget(part, Budget(), deadline,
+                                                  None)
+        return _normalize_closed(part, normalizer, deadline)
+
+    while start < len(text):
+        if start < isolated_end:
+            paragraph = text[start:boundaries[first]]
+            try:
+                normalized = normalize(paragraph, start, True)
+            except _BudgetExceeded:
+                raise
+            except Exception as error:
+                on_error(Diagnostic(_failing_stage(paragraph, normalizer),
+                                    offset + start, len(paragraph),
+                                    str(error)))
+            else:
+                if normalized:
+                    yield normalized
+            start, first = boundaries[first], first + 1
+            continue
+        paragraphs = (text[boundaries[index - 1] if index else 0:
+                           boundaries[index]]
+                      for index in range(first, len(boundaries)))
+        try:
+            end, normalized = next(_closed_runs(paragraphs, normalize,
+                                                part_size, start))
+        except _BudgetExceeded:
+            raise
+        except Exception as error:
+            end = start + len(attempted)
+            if end > boundaries[first]:
+                if part_size:
+                    # Narrow the error down to a paragraph.
+                    part_size = 0
+                    continue
+                isolated_end = end
+            on_error(Diagnostic(_failing_stage(text[start:end], normalizer),
+                                offset + start, boundaries[first] - start,
+                                str(error)))
+            start, first = boundaries[first], first + 1
+            continue
+        if normalized:
+            yield normalized
+        part_size = min(2 * (end - start), _RECOVERY_PART_SIZE)
+        start, first = end, bisect.bisect_left(boundaries, end) + 1
+
+
+def _closed_runs(pieces: Iterable[str],
+                 normalize: Callable[[str, int, bool], Optional[str]],
+                 check_size: int = 0, start: int = 0,
+                 eager_ends: Container[int] = frozenset()
+                 ) -> Iterator[Tuple[int, str]]:
+    r'''
+    Normalize the concatenation of pieces, every piece but the last
+    ending in a blank line, in runs of consecutive pieces leaving no
+    group, environment or equation open. Yields the end of every run
+    and its normalization, positions being counted from start.
+
+    A run is normalized by normalize, given its text, its start and
+    whether it is the last one, and returning None if the run is left
+    open, which the last one never is. A run is normalized once it is
+    check_size characters long, or as soon as it ends at one of
+    eager_ends. A run left open is normalized again with the pieces
+    following it once it is twice as long, so that a text with few
+    places to split at is normalized a bounded number of times.
+
+    >>> list(_closed_runs(['a $b\n\n', 'c$\n\n', 'd\n\n', 'e'],
+    ...                   lambda part, start, last: latex_normalizer(part)
+    ...                   if last else _normalize_closed(part)))
+    [(13, 'a d'), (14, 'e')]
+    '''
+    pending: List[str] = []
+    pending_size = 0
+    # The size a run left open has to reach to be normalized again.
+    failed_size = 0
+    pieces = iter(pieces)
+    piece = next(pieces, None)
+    while piece is not None:
+        pending.append(piece)
+        pending_size += len(piece)
+        piece = next(pieces, None)
+        last = piece is None
+        end = start + pending_size
+        if not last and pending_size < (
+                failed_size if end in eager_ends
+                else max(check_size, failed_size)):
+            continue
+        text = ''.join(pending)
+        normalized = normalize(text, start, last)
+        if normalized is None:
+            pending = [text]
+            failed_size = 2 * pending_size
+            continue
+        yield end, normalized
+        pending = []
+        pending_size = 0
+        failed_size = 0
+        start = end
+
+
+def _blank_line_pieces(chunks: Iterable[str], size: int) -> Iterator[str]:
+    r'''
+    Join chunks into pieces of at least size characters, every piece
+    but the last ending at the last blank line of the chunk it ends in.
+
+    >>> list(_blank_line_pieces(['a\n\nb', '\n', '\nc\n\nd', 'e'], 3))
+    ['a\n\n', 'b\n\nc\n\n', 'de']
+    '''
+    pending: List[str] = []
+    pending_size = 0
+    # The last character of the previous chunk, in which a blank line
+    # can start.
+    last_character = ''
+    for chunk in chunks:
+        if not chunk:
+            continue
+        pending.append(chunk)
+        pending_size += len(chunk)
+        searched = last_character + chunk
+        blank_line = searched.rfind('\n\n')
+        last_character = chunk[-1]
+        if pending_size < size or blank_line == -1:
+            continue
+        text = ''.join(pending)
+        split_pos = len(text) - len(searched) + blank_line + 2
+        yield text[:split_pos]
+        pending = [text[split_pos:]]
+        pending_size = len(pending[0])
+    yield ''.join(pending)
+
+
+def _fallback_normalization(text: str,
+                            normalizer: Normalizer = _DEFAULT_NORMALIZER
+                            ) -> str:
+    r'''
+    Normalize text crudely, in linear time, for texts exceeding their
+    Budget. Only the line comments and the command names are removed
+    before the special characters.
+
+    >>> _fallback_normalization('\\emph{Hi} {{{ $x$ % note\n')
+    'Hi x'
+    '''
+    text = _remove_line_comments(text, normalizer)
+    text = normalizer._command_regex.sub(' ', text)
+    return _remove_special_characters(text, normalizer)
+
+
+def _failing_stage(text: str,
+                   normalizer: Normalizer = _DEFAULT_NORMALIZER) -> str:
+    '''
+    Return the name of the first stage raising an error on text, or an
+    empty string if there is none.
+    '''
+    for name, stage, _ in _STAGES:
+        try:
+            text = stage(text, normalizer)
+        except Exception:
+            return name
+    return ''
+
+
+# The texts normalized together by normalize_many are joined by this
+# separator. The word in it passes all stages unchanged, and allows
+# splitting the texts apart again.
+_SEPARATOR_WORD = 'qzqnormalizemanyseparatorqzq'
+_SEPARATOR = f'\n\n{_SEPARATOR_WORD}\n\n'
+_DOLLAR_RUN_REGEX = re.compile(r'\$+')
+
+
+# The length of the longest texts that _normalize_batch joins. Joining
+# saves the overhead of a call per text, which only outweighs the cost
+# of checking the joined text for interactions for short texts.
+_JOINED_TEXT_SIZE = 120
+
+
+def _normalize_batch(texts: List[str],
+                     normalizer: Normalizer = _DEFAULT_NORMALIZER
+                     ) -> List[str]:
+    r'''
+    Normalize every text in texts, as normalizer does.
+
+    >>> _normalize_batch(['$a', 'b$ c', '\\emph{d}'])
+    Traceback (most recent call last):
+        ...
+    Exception: LaTeX syntax error
+    '''
+    # A comment on the last line is only a comment if a newline follows,
+    # as it does once the text is joined to the next one.
+    alone = {index for index, text in enumerate(texts)
+             if len(text) > _JOINED_TEXT_SIZE
+             or '%' in text[text.rfind('\n') + 1:]
+             or _SEPARATOR_WORD in text}
+    results: List[Optional[str]] = [None] * len(texts)
+    for attempt in range(2):
+        joined = [index for index in range(len(texts)) if index not in alone]
+        normalized, interacting = _normalize_joined(
+            [texts[index] for index in joined], normalizer)
+        if normalized is not None:
+            for index, text in zip(joined, normalized):
+                results[index] = text
+            break
+        # The texts interacting with others are normalized on their own
+        # below. If the rest still interacts, give up on joining them.
+        if attempt:
+            interacting = set(range(len(joined)))
+        alone.update(joined[position] for position in interacting)
+    for index in sorted(alone):
+        results[index] = normalizer(texts[index])
+    return results
+
+
+def _normalize_joined(texts: List[str],
+                      normalizer: Normalizer = _DEFAULT_NORMALIZER
+                      ) -> Tuple[Optional[List[str]], Set[int]]:
     r'''
-    Match two-character brackets in a string, and return lists of pairs
-    of positions of the matching brackets, indexed in a dictionary by
-    bracket type.
+    Normalize texts by running the stages once on the texts joined by
+    _SEPARATOR.
 
-    Positional arguments:
-    text -- The string where we want to find the matching brackets.
-    brackets -- Dictionary whose keys are the closing brackets, and
-    whose values are the opening brackets.
+    Returns the normalized texts, or None and the positions of the
+    texts whose normalization may be influenced by the other texts.
 
-    >>> _matching_brackets_digram('abcd')
-    []
+    >>> _normalize_joined(['\\emph{a}', 'b\\cite{c', 'd}', 'e'])
+    (None, {1, 2})
+    '''
+    if not texts:
+        return [], set()
+    everything = set(range(len(texts)))
+    text = _SEPARATOR.join(texts)
+    text = _remove_line_comments(text, normalizer)
+    text = _remove_accents(text, normalizer)
+    # Removing accents and environments can glue letters together into
+    # a new separator, after which the texts can not be told apart.
+    if text.count(_SEPARATOR_WORD) != len(texts) - 1:
+        return None, everything
+    interacting = _crossing_texts(
+        text, _argument_brackets(text, normalizer._normalized_command_regex))
+    if interacting:
+        return None, interacting
+    text = _normalize_commands(text, normalizer)
+    spans, _ = _environment_spans(_environment_delimiters(text, normalizer),
+                                  normalizer)
+    interacting = _crossing_texts(text, spans)
+    if interacting:
+        return None, interacting
+    text = _remove_environments(text, normalizer)
+    if text.count(_SEPARATOR_WORD) != len(texts) - 1:
+        return None, everything
+    interacting = _crossing_texts(
+        text, _argument_brackets(text, normalizer._command_regex))
+    if interacting:
+        return None, interacting
+    text = _remove_commands(text, normalizer)
+    if text.count(_SEPARATOR_WORD) != len(texts) - 1:
+        return None, everything
+    # All backslashes are gone, so the dollar signs can be matched
+    # without regard for escapes, starting afresh in every text.
+    separators = [match.start() for match
+                  in re.finditer(_SEPARATOR_WORD, text)]
+    dollar_runs: Dict[int, List[Tuple[int, int]]] = {}
+    for match in _DOLLAR_RUN_REGEX.finditer(text):
+        start, end = match.span()
+        dollar_runs.setdefault(bisect.bisect(separators, start), []).append(
+            (start, end - start))
+    intervals = []
+    for position, runs in dollar_runs.items():
+        text_intervals = _dollar_intervals(runs)
+        if text_intervals is None:
+            interacting.add(position)
+        else:
+            intervals += text_intervals
+    if interacting:
+        return None, interacting
+    text = _excise_intervals(text, intervals)
+    text = _remove_bracket_equations(text)
+    text = _remove_special_characters(text, normalizer)
+    return [part.strip() for part in text.split(_SEPARATOR_WORD)], set()
 
-    >>> _matching_brackets_digram(r'\( \)')
-    [(0, 4)]
 
-    >>> _matching_brackets_digram(r'\(\(\)\)')
-    [(2, 5), (0, 7)]
+def _dollar_intervals(runs: Iterable[Tuple[int, int]]
+                      ) -> Optional[List[Tuple[int, int]]]:
+    r'''
+    Match the runs of dollar signs of a text, given by their starting
+    positions and lengths, into equations.
 
-    >>> _matching_brackets_digram(r'\(\(\(\)')
-    Traceback (most recent call last):
-        ...
-    Exception: brackets are unbalanced
+    Returns the intervals of the equations, as _remove_dollar_equations
+    removes them, or None if the dollar signs are not valid syntax.
 
-    >>> _matching_brackets_digram(r'\(')
-    Traceback (most recent call last):
-        ...
-    Exception: brackets are unbalanced
+    >>> _dollar_intervals([(0, 1), (7, 3), (19, 2)])
+    [(0, 7), (8, 20)]
 
-    >>> _matching_brackets_digram(r'\)')
-    Traceback (most recent call last):
-        ...
-    Exception: brackets are unbalanced
+    >>> _dollar_intervals([(0, 2), (3, 1)]) is None
+    True
     '''
-    opening_brackets = []
-    matches = []
-    digrams = [a + b for a, b in zip(text, text[1:])]
-    for pos, digram in enumerate(digrams):
-        if digram == open_bracket:
-            opening_brackets.append((digram, pos))
-        elif digram == close_bracket:
-            try:
-                open_bracket, open_pos = opening_brackets.pop()
-                # pos is the position of the first character of the
-                # closing bracket, but we want to include both
-                # of its characters in the interval, so we append
-                # pos + 1.
-                matches.append((open_pos, pos + 1))
-            except IndexError:
-                raise Exception('brackets are unbalanced')
-    if opening_brackets:
-        raise Exception('brackets are unbalanced')
-    else:
-        return matches
+    intervals = []
+    matcher = _DollarMatcher()
+    open_pos = 0
+    try:
+        for start, length in runs:
+            if length > 4:
+                return None
+            closing = matcher.match(length)
+            if closing:
+                intervals.append((open_pos, start + closing - 1))
+            open_pos = start + closing
+        matcher.close()
+    except Exception:
+        return None
+    return intervals
 
 
-def _interval_to_indices(interval: Tuple[int, int]) -> List[int]:
-    '''
-    Takes an interval, and returns the set of indices that the interval
-    comprises, right and left inclusive.
+def _crossing_texts(text: str, spans: Iterable[Tuple[int, Optional[int]]]
+                    ) -> Set[int]:
+    r'''
+    Find the positions of the texts joined in text that a span starts,
+    ends or lies in, for every span crossing a separator.
 
-    >>> _interval_to_indices((1,1))
-    [1]
+    >>> _crossing_texts(f'ab{_SEPARATOR}cd{_SEPARATOR}ef', [(0, 1), (1, 68)])
+    {0, 1, 2}
+    '''
+    separators = [match.start() for match
+                  in re.finditer(_SEPARATOR_WORD, text)]
+    crossing = set()
+    for start, end in spans:
+        if end is None:
+            continue
+        first = bisect.bisect(separators, start)
+        last = bisect.bisect(separators, end)
+        if first != last:
+            crossing.update(range(first, last + 1))
+    return crossing
 
-    >>> _interval_to_indices((3,5))
-    [3, 4, 5]
 
-    >>> _interval_to_indices((3,2))
-    Traceback (most recent call last):
-        ...
-    Exception: interval out of order
-    '''
-    x, y = interval
-    if y < x:
-        raise Exception('interval out of order')
-    else:
-        return list(range(x, y+1))
+# The stages of latex_normalizer, in order, with the names of the regexes
+# of the normalizer they use, for the instrumentation.
+_STAGES = [
+    ('_remove_line_comments', _remove_line_comments,
+     ['_line_comment_regex']),
+    ('_remove_accents', _remove_accents,
+     ['_letter_accent_regex', '_non_letter_accent_regex']),
+    ('_normalize_commands', _normalize_commands,
+     ['_normalized_command_regex', '_spaced_normalized_command_regex']),
+    ('_remove_environments', _remove_environments,
+     ['_environment_label_regex']),
+    ('_remove_commands', _remove_commands,
+     ['_command_regex']),
+    ('_remove_dollar_equations', _remove_dollar_equations,
+     ['_dollar_run_regex']),
+    ('_remove_bracket_equations',
+     lambda text, normalizer: _remove_bracket_equations(text),
+     []),
+    ('_remove_special_characters', _remove_special_characters,
+     []),
+]
 
 
-def _excise_intervals(text: str, intervals: List[Tuple[int, int]]) -> str:
-    r'''
-    Takes a string and a list of intervals, and returns the string with
-    these intervals replaced by single white spaces.
+# The words of a normalized text, when Unicode is not kept.
+_WORD_REGEX = re.compile(r'[a-zA-Z]+')
 
-    >>> _excise_intervals('hey', [])
-    'hey'
 
-    >>> _excise_intervals('Remove this and nothing else', [(7, 10)])
-    'Remove   and nothing else'
+# The number of characters after the previous word in which
+# _offset_map_by_search looks for the next one.
+_OFFSET_SEARCH_WINDOW = 2**10
 
-    >>> _excise_intervals('Remove this and nothing else', [(7, 8), (9, 10)])
-    'Remove    and nothing else'
 
-    >>> _excise_intervals('Remove this and nothing else', [(7, 10), (8, 9)])
-    'Remove   and nothing else'
+def _offset_map_by_search(normalized: str, text: str) -> OffsetMap:
+    r'''
+    Map the words of normalized to their first occurrences in text, in
+    order.
 
-    >>> _excise_intervals('Remove this and nothing else', [(7, 9), (8, 10)])
-    Traceback (most recent call last):
-        ...
-    Exception: non-trivially overlapping intervals
+    Every word is looked for in a window of _OFFSET_SEARCH_WINDOW
+    characters after the previous one, first as a whole and then piece
+    by piece, as a word glued together from several pieces, such as a
+    word with an accent removed. It is then looked for as a whole among
+    the letter runs of text further on, found with an index built once.
+    A word found nowhere thus costs a bounded search, and maps to the
+    position after the previous word.
 
-    >>> _excise_intervals('hey', [(3, 4)])
-    Traceback (most recent call last):
-        ...
-    Exception: interval out of bounds
+    >>> offsets = _offset_map_by_search('a bc', 'x a y bc')
+    >>> list(offsets.starts), list(offsets.source_starts)
+    ([0, 2], [2, 6])
 
-    >>> _excise_intervals('hey', [(2, 3)])
-    Traceback (most recent call last):
-        ...
-    Exception: interval out of bounds
+    >>> offsets = _offset_map_by_search('ab c', 'a\\"b ' + ' ' * 2000 + 'c')
+    >>> list(offsets.starts), list(offsets.source_starts)
+    ([0, 1, 3], [0, 3, 2005])
     '''
-    # Store the indices spanned by the intervals in a list ii_list of
-    # tuples of the form (index, indicator), where indicator is 1 if
-    # index does not occur as a non-first element of an interval. That
-    # is, if we have intervals (1,3), (2,3), then ii_list will consist
-    # of (1,1), (2,0), (3,0), not (1,1), (2,1), (3,0).
-    ii_list = []
-    indices_list = []
-    for start, end in sorted(intervals):
-        if start in indices_list:
-            if end in indices_list:
-                continue
-            else:
-                raise Exception('non-trivially overlapping intervals')
+    starts = array('l')
+    source_starts = array('l')
+    position = 0
+    source_position = 0
+    # The start of every letter run of text, by run.
+    run_starts: Optional[Dict[str, List[int]]] = None
+    for word in normalized.split(' ') if normalized else []:
+        window_end = source_position + _OFFSET_SEARCH_WINDOW + len(word)
+        found = text.find(word, source_position, window_end)
+        if found != -1:
+            pieces = [(0, found)]
         else:
-            indicators = [1] + [0] * (end - start)
-            indices = _interval_to_indices((start, end))
-            indices_indicators = list(zip(indices, indicators))
-            indices_list = indices_list + indices
-            ii_list = ii_list + indices_indicators
-
-    # Reverse the indices because removal by index is not a commutative
-    # operation.
-    ii_list = sorted(ii_list, reverse=True)
-    # Remove the indices from the string, taking care to replace it by
-    # a single space if the index does not occur as a non-first
-    # character in the intervals.
-    if intervals:
-        if max(indices_list) > len(text) - 1:
-            raise Exception('interval out of bounds')
-        for index, indicator in ii_list:
-            if indicator:
-                text = text[:index] + ' ' + text[index + 1:]
-            else:
-                text = text[:index] + text[index + 1:]
-    return text
+            pieces = _glued_word_pieces(word, text, source_position,
+                                        window_end)
+        if not pieces:
+            if run_starts is None:
+                run_starts = {}
+                for match in _WORD_REGEX.finditer(text):
+                    run_starts.setdefault(match.group(), []).append(
+                        match.start())
+            word_starts = run_starts.get(word, [])
+            index = bisect.bisect_left(word_starts, source_position)
+            if index < len(word_starts):
+                pieces = [(0, word_starts[index])]
+        if pieces:
+            last_start, last_source_start = pieces[-1]
+            source_position = last_source_start + len(word) - last_start
+        else:
+            pieces = [(0, source_position)]
+        for start, source_start in pieces:
+            if not starts or source_start != (source_starts[-1] + position
+                                              + start - starts[-1]):
+                starts.append(position + start)
+                source_starts.append(source_start)
+        position += len(word) + 1
+    return OffsetMap(starts, source_starts)
 
 
-def _remove_line_comments(text: str) -> str:
+def _glued_word_pieces(word: str, text: str, start: int, end: int
+                       ) -> List[Tuple[int, int]]:
     r'''
-    Remove line comments from latex code.
-
-    Specifically, this takes all text between % and the next newline,
-    and replaces it with a single space. This is not done if the percent
-    symbol is preceded by an odd number of back slashes. This is because
-    for example "\\\% " is not ignored by the latex compiler. It prints
-    a percent symbol on a new line.
-
-    >>> _remove_line_comments('Hi, I do not contain any comments. \n')
-    'Hi, I do not contain any comments. \n'
+    Find the letters of word in order in text between start and end,
+    taking as many consecutive ones as match at every place. Returns
+    the start of every piece in word and in text, or an empty list if
+    some letter is not found.
 
-    >>> _remove_line_comments('Hi, I do. %comment\nNext line.')
-    'Hi, I do.  Next line.'
+    >>> _glued_word_pieces('Godel', 'G\\"odel', 0, 7)
+    [(0, 0), (1, 3)]
+    '''
+    pieces = []
+    position = 0
+    while position < len(word):
+        found = text.find(word[position], start, end)
+        if found == -1:
+            return []
+        pieces.append((position, found))
+        while position < len(word) and found < end \
+                and text[found] == word[position]:
+            position += 1
+            found += 1
+        start = found
+    return pieces
 
-    >>> _remove_line_comments('Me too. \\\\% comment\n')
-    'Me too. \\\\ '
 
-    >>> _remove_line_comments('0\\%\n')
-    '0\\%\n'
-    '''
-    line_comment_regex = re.compile(r'(?<!\\)((?:\\\\)*)%.*\n')
-    return line_comment_regex.sub(r'\1 ', text)
+# The suffixes of the archive members read by archive_sources.
+_ARCHIVE_SUFFIXES = ('.gz', '.tgz', '.tar', '.zip')
 
 
-def _remove_accents(text: str) -> str:
+def archive_sources(path: str,
+                    on_error: Optional[Callable[[str, Exception], None]]
+                    = None) -> Iterator[Tuple[str, bytes]]:
     r'''
-    Replace latex code for diacritics with the empty string.
+    Yield the name and contents of every .tex file in the tar, gzip or
+    zip archive at path, reading tar archives as a stream.
 
-    Replace letters with diacritics by their non-diacritical
-    counterpart. For example, hyperk\"ahler becomes hyperkahler.
-    Moreover, hyperk\"{a}hler becomes hyperkahler too.
+    The members that are archives themselves, as the gzipped sources of
+    the papers in arXiv bulk archives, are read as well, their members
+    being named after them. A gzipped file that is not a tar archive is
+    taken to be a single tex file, named after it without the .gz, if
+    it is the archive at path or if that name ends in .tex or has no
+    extension, as the arXiv identifier 0704.0001. Other gzipped
+    members, such as figure.eps.gz, are skipped.
 
-    >>> _remove_accents('Nothing happens to me')
-    'Nothing happens to me'
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     path = os.path.join(directory, 'papers.zip')
+    ...     with zipfile.ZipFile(path, 'w') as archive:
+    ...         archive.writestr('paper/main.tex', '\\emph{Hi}')
+    ...         archive.writestr('paper/figure.pdf', '')
+    ...         archive.writestr('other.gz', gzip.compress(b'there'))
+    ...         archive.writestr('figure.eps.gz', gzip.compress(b'%!PS'))
+    ...     for name, data in archive_sources(path):
+    ...         print(os.path.relpath(name, directory), data)
+    papers.zip/paper/main.tex b'\\emph{Hi}'
+    papers.zip/other b'there'
 
-    >>> _remove_accents('hyperk\\"ahler is hyperk\\"{a}hler')
-    'hyperkahler is hyperkahler'
+    If on_error is given, a member that can not be read, as a corrupt
+    member archive, does not abort reading the archive at path. It is
+    skipped instead, and on_error is called with its name and the
+    error.
 
-    >>> _remove_accents('\\c Ca va? \\c{C}a va')
-    'Ca va? Ca va'
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     path = os.path.join(directory, 'bulk.zip')
+    ...     with zipfile.ZipFile(path, 'w') as archive:
+    ...         archive.writestr('0704.0001.gz', gzip.compress(b'one'))
+    ...         archive.writestr('0704.0002.gz', b'not gzipped')
+    ...         archive.writestr('0704.0003.gz', gzip.compress(b'three'))
+    ...     for name, data in archive_sources(
+    ...             path, lambda name, error: print(
+    ...                 os.path.relpath(name, directory), error)):
+    ...         print(os.path.relpath(name, directory), data)
+    bulk.zip/0704.0001 b'one'
+    bulk.zip/0704.0002.gz truncated header
+    bulk.zip/0704.0003 b'three'
     '''
-    letters = [
-            'u',
-            'v',
-            'H',
-            't',
-            'c',
-            'd',
-            'b',
-            'k',
-            ]
-    letter_accent_regex = re.compile(
-            r'\\(?:'
-            + '|'.join(letters)
-            + r')(?:\ |{(\w{1,2})})'
-            )
-    non_letters = [
-            r'\'',
-            r'`',
-            r'\^',
-            r'"',
-            r'~',
-            r'=',
-            r'\.',
-            ]
-    non_letter_accent_regex = re.compile(
-            r'\\(?:'
-            + '|'.join(non_letters)
-            + r')(?:{(\w)})?'
-            )
-    output = letter_accent_regex.sub(r'\1', text)
-    output = non_letter_accent_regex.sub(r'\1', output)
-    return output
+    with open(path, 'rb') as file:
+        yield from _archive_sources(path, file, True, on_error)
 
 
-def _normalize_commands(text: str) -> str:
-    r'''
-    Replace a list of specified latex commands with their arguments.
+def _archive_sources(name: str, file: BinaryIO, top_level: bool = False,
+                     on_error: Optional[Callable[[str, Exception], None]]
+                     = None) -> Iterator[Tuple[str, bytes]]:
+    '''
+    Yield the .tex files in the archive named name read from the
+    seekable file, as archive_sources does, top_level being set for the
+    archive given to archive_sources.
+    '''
+    if zipfile.is_zipfile(file):
+        with zipfile.ZipFile(file) as archive:
+            for info in archive.infolist():
+                if _is_source(info.filename) and not info.is_dir():
+                    yield from _member_sources(
+                        f'{name}/{info.filename}',
+                        functools.partial(archive.read, info), on_error)
+        return
+    file.seek(0)
+    try:
+        with tarfile.open(fileobj=file, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile() and _is_source(member.name):
+                    yield from _member_sources(
+                        f'{name}/{member.name}',
+                        archive.extractfile(member).read, on_error)
+        return
+    except tarfile.TarError:
+        file.seek(0)
+        if file.read(2) != b'\x1f\x8b':
+            raise
+    file.seek(0)
+    with gzip.GzipFile(fileobj=file) as gzip_file:
+        data = gzip_file.read()
+    base_name = re.sub(r'\.gz$', '', name)
+    if base_name.endswith(_ARCHIVE_SUFFIXES):
+        yield from _member_sources(base_name, lambda: data, on_error)
+    elif top_level or _is_gzipped_source(base_name):
+        yield base_name, data
 
-    More concretely, this function replaces "\command{argument}" with
-    " argument ", where command is a command from the list
-        subsubsection,
-        subsection,
-        section,
-        chapter,
-        title,
-        author,
-        footnote,
-        emph,
-        text,
-        textit,
-        textrm.
-    If no argument is passed to the command, the command is replaced
-    with an empty string.
 
-    >>> _normalize_commands('\shouldnt{change}')
-    '\\shouldnt{change}'
+def _is_gzipped_source(name: str) -> bool:
+    '''
+    Whether a gzipped file that is not an archive, named name without
+    the .gz, is a tex file: if name ends in .tex, or has no extension
+    but digits, as the arXiv identifiers.
 
-    >>> _normalize_commands('\chapter{On{e}')
-    ' On{e}'
+    >>> [_is_gzipped_source(name)
+    ...  for name in ['a/main.tex', 'a/0704.0001', 'a.b/c', 'a/fig.eps']]
+    [True, True, True, False]
+    '''
+    extension = os.path.splitext(name)[1][1:]
+    return extension in ('tex', '') or extension.isdigit()
 
-    >>> _normalize_commands('\chapter{Hyperk\\"{a}hlers}')
-    ' Hyperk\\"{a}hlers '
 
-    >>> _normalize_commands('\chapter{One} \section{two}')
-    ' One   two '
+def _is_source(name: str) -> bool:
+    return name.endswith(('.tex', *_ARCHIVE_SUFFIXES))
 
-    >>> _normalize_commands('\sectionheader')
-    '\\sectionheader'
+
+def _member_sources(name: str, read: Callable[[], bytes],
+                    on_error: Optional[Callable[[str, Exception], None]]
+                    = None) -> Iterator[Tuple[str, bytes]]:
     '''
-    normalized_commands = [
-        'subsubsection',
-        'subsection',
-        'section',
-        'chapter',
-        'title',
-        'author',
-        'footnote',
-        'emph',
-    ]
-    normalized_commands_regex = re.compile(
-        r'\\('
-        + '|'.join(normalized_commands)
-        + ')(?={)'
-        )
-    matches = normalized_commands_regex.finditer(text)
-    for match in matches:
-        _, open_pos = match.span()
-        try:
-            # Try to find the bracket matching the bracket at the end
-            # of the command. If successful, replace both by a single
-            # space.
-            delta = _matching_paren_pos(text[open_pos:])
-            close_pos = open_pos + delta
-            text = text[:open_pos] \
-                + ' ' \
-                + text[open_pos + 1:close_pos] \
-                + ' ' \
-                + text[close_pos + 1:]
-        except Exception:
-            # if the opening bracket is unmatched, only have to replace
-            # the opening bracket
-            text = text[:open_pos] \
-                    + ' ' \
-                    + text[open_pos + 1:]
+    Yield the member named name with the contents returned by read if
+    it is a .tex file, or the .tex files in it if it is an archive.
 
-    normalized_commands_regex = re.compile(
-        r'\\('
-        + '|'.join(normalized_commands)
-        + ')(?= )'
-        )
-    return normalized_commands_regex.sub('', text)
+    If on_error is given, an error reading the member is passed to it
+    with name instead of being raised.
+    '''
+    try:
+        data = read()
+        if name.endswith('.tex'):
+            yield name, data
+        else:
+            yield from _archive_sources(name, io.BytesIO(data),
+                                        on_error=on_error)
+    except Exception as error:
+        if on_error is None:
+            raise
+        on_error(name, error)
 
 
-def _remove_environments(text: str) -> str:
+class ShardWriter:
     r'''
-    Remove a specified list of latex environments.
+    Writes records as lines of JSON to compressed shards in directory,
+    named part-00000.jsonl.gz and so on, numbered on from the shards
+    already there. The compression is gzip or xz.
 
-    Specifically, replace "\begin{environment} contents
-    \end{environment}" with the empty string, where environment is
-    an environment on the list
-        comment,
-        figure,
-        tikzpicture,
-        equation(*),
-        multline(*),
-        align(*),
-        gather(*).
-    '''
-    removed_env = [
-        r'comment',
-        r'figure',
-        r'tikzpicture',
-        r'equation\*?',
-        r'multline\*?',
-        r'align\*?',
-        r'gather\*?',
-    ]
-    for env in removed_env:
-        env_regex = re.compile(r'\\begin{'
-                               + env
-                               + r'}[\s\S]*?\\end{'
-                               + env
-                               + r'}')
-        text = env_regex.sub('', text)
-    return text
+    Every shard is written to a temporary file, and moved to its name
+    once it holds shard_size records, or the writer is closed. A shard
+    found under its name is thus complete. If the writer is left with
+    an exception, the shard being written is discarded instead.
 
-
-def _strip_environments_labels(text: str) -> str:
-    '''
-    Remove environment delimiters and labels.
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     with ShardWriter(directory, shard_size=2) as writer:
+    ...         for text in ['a', 'b', 'c']:
+    ...             writer.write({'text': text})
+    ...     with gzip.open(writer.paths[1], 'rt') as shard:
+    ...         lines = shard.read()
+    ...     names = sorted(os.listdir(directory))
+    >>> names, lines
+    (['part-00000.jsonl.gz', 'part-00001.jsonl.gz'], '{"text": "c"}\n')
     '''
-    env_regex = re.compile(r'\\(begin|end|label){.*?}')
-    return env_regex.sub(' ', text)
 
+    _OPENERS = {'gzip': (gzip.open, '.gz'), 'xz': (lzma.open, '.xz')}
 
-def _remove_commands(text: str) -> str:
-    r'''
-    Remove entire commands.
+    def __init__(self, directory: str, compression: str = 'gzip',
+                 shard_size: int = 10000) -> None:
+        self.directory = directory
+        self.shard_size = shard_size
+        self.paths: List[str] = []
+        self._open, self._suffix = self._OPENERS[compression]
+        os.makedirs(directory, exist_ok=True)
+        indices = [int(match.group(1)) for match in map(
+            re.compile(r'part-(\d+)\.jsonl\.').match, os.listdir(directory))
+            if match]
+        self._next_index = max(indices, default=-1) + 1
+        self._file: Optional[Any] = None
+        self._temporary_path = ''
+        self._size = 0
 
-    More concretely, this remove all commands and their arguments
-    (optional or otherwise). That is, "\a*{b}[c]{d}$ is replaced with
-    a single space.
+    def __enter__(self) -> 'ShardWriter':
+        return self
 
-    >>> _remove_commands('abc')
-    'abc'
+    def __exit__(self, exc_type, *exc_info) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._discard()
 
-    >>> _remove_commands('\command*{baba}[caba]{daba}a')
-    ' a'
+    def write(self, record: Dict[str, Any]) -> None:
+        if self._file is None:
+            self._temporary_path = os.path.join(
+                self.directory, f'part-{self._next_index:05}.jsonl'
+                f'{self._suffix}.tmp')
+            self._next_index += 1
+            self._file = self._open(self._temporary_path, 'wt',
+                                    encoding='utf-8')
+        self._file.write(json.dumps(record) + '\n')
+        self._size += 1
+        if self._size >= self.shard_size:
+            self.close()
 
-    >>> _remove_commands('\command')
-    ' '
+    def close(self) -> None:
+        '''
+        Move the shard being written, if any, to its name.
+        '''
+        if self._file is None:
+            return
+        self._file.close()
+        path = self._temporary_path[:-len('.tmp')]
+        os.replace(self._temporary_path, path)
+        self.paths.append(path)
+        self._file = None
+        self._size = 0
 
-    >>> _remove_commands('\command[option]')
-    ' '
+    def _discard(self) -> None:
+        if self._file is None:
+            return
+        self._file.close()
+        os.remove(self._temporary_path)
+        self._file = None
+        self._size = 0
 
-    >>> _remove_commands('\command{argument')
-    ' argument'
 
-    >>> _remove_commands('a \command and \\another{one}')
-    'a   and  '
+def _normalize_source(source: Tuple[str, bytes], recover: bool = False,
+                      budget: Optional[Budget] = None
+                      ) -> Tuple[str, int, Optional[str], Optional[str],
+                                 List[Diagnostic], str]:
+    '''
+    Normalize a tex file read from an archive, as its name and
+    contents, decoded by _decode_source, within budget.
 
-    >>> _remove_commands('\@command')
-    ' '
+    Returns the name, the size of the contents, the normalized text,
+    the error raised instead, if any, the diagnostics of the parts
+    dropped and of the limits exceeded if recover is set, and the
+    encoding of the contents.
     '''
-    # The values and keys of this dictionary will be used as input for
-    # _matching_paren_pos later.
-    paren_dict = {
-            '{': '}',
-            '[': ']',
-            }
-    # The next regex matches anything of the form '\word*' and '\word'.
-    command_regex = re.compile(r'\\[\w@]*\*?')
-
-    head = ''
-    tail = text
-    while tail:
-        # Split the tail at the first occurring command, replacing the
-        # command by a space. Should only do one split at a time,
-        # because input like "\command{\command}" is possible.
-        broken_text = command_regex.split(tail, maxsplit=1)
-        if len(broken_text) == 1:
-            head = head + broken_text[0]
-            break
-        head = head + broken_text[0] + ' '
-        tail = broken_text[1]
-        # Iteratively remove everything between consecutive brackets in
-        # tail.
-        while tail:
-            if tail[0] in paren_dict.keys():
-                try:
-                    close_pos = _matching_paren_pos(
-                            tail,
-                            open_paren=tail[0],
-                            close_paren=paren_dict[tail[0]]
-                            )
-                    tail = tail[close_pos + 1:]
-                # If the opening bracket is unmatched, an exception
-                # is raised and we only remove the opening bracket,
-                # and we go back to searching for a command.
-                except Exception:
-                    tail = tail[1:]
-                    break
-        # If the leading character of tail is not an opening bracket,
-        # go back to searching for a command.
-            else:
-                break
-    return head
+    name, data = source
+    diagnostics: List[Diagnostic] = []
+    text, encoding = _decode_source(data)
+    try:
+        normalized = _DEFAULT_NORMALIZER(
+            text, on_error=diagnostics.append if recover else None,
+            budget=budget)
+    except Exception as error:
+        return name, 0, None, f'{type(error).__name__}: {error}', [], \
+            encoding
+    return name, len(data), normalized, None, diagnostics, encoding
 
 
-def _remove_bracket_equations(text: str) -> str:
+def _decode_source(data: bytes) -> Tuple[str, str]:
     r'''
-    Remove inline and display equations delimited by \( and \[.
+    Decode the contents of a tex file as UTF-8, or as Latin-1 if they
+    are not valid UTF-8, as _open_source does, with universal newlines
+    as files are read. Returns the text and its encoding.
 
-    >>> _remove_bracket_equations('abc')
-    'abc'
+    >>> _decode_source(b'G\xf6del\r\n')
+    ('G\xf6del\n', 'latin-1')
+    '''
+    try:
+        text, encoding = data.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError:
+        text, encoding = data.decode('latin-1'), 'latin-1'
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text, encoding
 
-    >>> _remove_bracket_equations(r'These too: \(1 + 1\)')
-    'These too:  '
 
-    >>> _remove_bracket_equations(r'This is an equation: \[1 + 1 = \$\]')
-    'This is an equation:  '
+def _collect_paths(patterns: Iterable[str], output_dir: Optional[str]
+                   ) -> List[Tuple[str, str]]:
+    r'''
+    Expand files, directories and glob patterns into pairs of source
+    and target paths.
 
-    >>> _remove_bracket_equations(r'This is not: \(1 \[+\] 1\)')
-    'This is not:  '
+    Directories are searched recursively for .tex files. The target of
+    a source is the source followed by "_normalized", or, if output_dir
+    is given, the path of the source relative to the parent of the
+    directory it was found in, or to the working directory, placed in
+    output_dir. Sources outside of the working directory are placed
+    there by their names.
 
-    >>> _remove_bracket_equations(r'This is not: \[1 \(+\) 1\]')
-    'This is not:  '
-    '''
-    round_bracket_intervals = _matching_brackets_digram(text)
-    square_bracket_intervals = _matching_brackets_digram(text,
-                                                         open_bracket=r'\[',
-                                                         close_bracket=r'\]')
-    intervals_to_remove = round_bracket_intervals + square_bracket_intervals
-    return _excise_intervals(text, intervals_to_remove)
+    A source given more than once is only normalized once. Raises
+    ValueError if two sources would be normalized to the same target.
 
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     paths = [os.path.join(directory, paper, 'main.tex')
+    ...              for paper in ['p1', 'p2']]
+    ...     for path in paths:
+    ...         os.makedirs(os.path.dirname(path))
+    ...         open(path, 'w').close()
+    ...     pairs = _collect_paths(map(os.path.dirname, paths), 'out')
+    ...     try:
+    ...         _collect_paths(paths, 'out')
+    ...     except ValueError as error:
+    ...         message = str(error)
+    >>> [target for _, target in pairs]
+    ['out/p1/main.tex_normalized', 'out/p2/main.tex_normalized']
+    >>> message.endswith('would both be normalized to out/main.tex_normalized')
+    True
+    '''
+    pairs = []
+    # The source normalized to every target.
+    sources_by_target: Dict[str, str] = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            # The name of the directory is kept, so that the files of
+            # directories laid out alike, as papers with a main.tex
+            # each, are not normalized to the same targets.
+            base = os.path.dirname(os.path.normpath(pattern)) or os.curdir
+            sources = sorted(glob.glob(os.path.join(pattern, '**', '*.tex'),
+                                       recursive=True))
+        else:
+            base = os.curdir
+            sources = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for source in sources:
+            if output_dir is None:
+                target = source
+            else:
+                relative_path = os.path.relpath(source, base)
+                if relative_path.startswith(os.pardir):
+                    relative_path = os.path.basename(source)
+                target = os.path.join(output_dir, relative_path)
+            target = os.path.normpath(f'{target}_normalized')
+            known_source = sources_by_target.get(target)
+            if known_source is not None:
+                if os.path.realpath(known_source) != os.path.realpath(source):
+                    raise ValueError(f'{known_source} and {source} would '
+                                     f'both be normalized to {target}')
+                continue
+            sources_by_target[target] = source
+            pairs.append((source, target))
+    return pairs
 
-def _remove_dollar_equations(text: str) -> str:
-    r'''
-    Remove inline and display equations delimited by $ or $$.
 
-    >>> _remove_dollar_equations(r'No equation, \$3.50, \$2')
-    'No equation, \\$3.50, \\$2'
+# The cache used by the current worker process of the command line
+# interface, if any.
+_WORKER_CACHE: Optional[NormalizationCache] = None
 
-    >>> _remove_dollar_equations('An equation $1 + 1\$$ should go')
-    'An equation   should go'
 
-    >>> _remove_dollar_equations('Display equations $$\n 1 + 1 \n $$ too')
-    'Display equations   too'
+def _open_worker_cache(path: str, max_size: int) -> None:
+    global _WORKER_CACHE
+    _WORKER_CACHE = NormalizationCache(path, max_size)
 
-    >>> _remove_dollar_equations('$ back $$ to $$ back $')
-    '   '
 
-    >>> _remove_dollar_equations('$$ $$$$ $$')
-    '  '
+def _normalize_file(paths: Tuple[str, str], recover: bool = False,
+                    project: bool = False, budget: Optional[Budget] = None
+                    ) -> Tuple[int, Optional[str], Optional[bool],
+                               List[Diagnostic]]:
+    '''
+    Normalize the file at the first path into the second one, or, if
+    project is set, the project with that root file, within budget.
 
-    >>> _remove_dollar_equations(r'$$ \text{$nested$} $$')
-    Traceback (most recent call last):
-        ...
-    Exception: LaTeX syntax error
+    Returns the size of the source file, the error raised, if any,
+    whether the result was found in the cache of the worker, or None
+    if it has no cache, and the diagnostics of the parts dropped and
+    of the limits exceeded if recover is set. The target is written to
+    a temporary file first, so that no target is left behind if
+    normalizing fails.
 
-    >>> _remove_dollar_equations('$ back $$$ to back $$')
-    '  '
+    Results recovered from errors are not cached. Files normalized
+    within a budget are not looked up in the cache either if recover is
+    set, so that the limits they exceed are reported every time, as
+    TexProject does.
     '''
-    # First check if the latex syntax is valid. Up to 4 dollar signs
-    # in a row are allowed, 5 if the first is preceded by and odd
-    # number of backslashes (compiling to a bunch of line breaks and a
-    # dollar sign).
-    bad_syntax_regex = re.compile(r'(?<!\\)(?:\\\\)*\${5}')
-    if bad_syntax_regex.search(text):
-        raise Exception('LaTeX syntax error')
-    # Store the starting positions of delimiters of the form $, $$,
-    # $$$, $$$$, and their lengths in tokens.
-    token_regex = re.compile(r'(?<!\\)(?:\\\\)*(\${1,4})')
-    spans = [match.span() for match in token_regex.finditer(text)]
-    tokens = [(start, finish - start) for start, finish in spans]
-    # Going from right to left through tokens, match each token to a
-    # substring of the next token of equal length. Store the resulting
-    # interval in intervals, and append the remainder of the next token
-    # to tokens. If this is not possible, raise a syntax error. The
-    # correctness of this algorithm relies on there not being any
-    # nested equations. For example, it does not distinguish between
-    # '$1 + \text{$1 = 2$ and } 1 + 2 = 3$' and the equations
-    # '$1 + 1 = 2$ and $1 + 2 = 3$'.
-    intervals = []
-    while tokens:
-        try:
-            close_pos, close_len = tokens.pop()
-            open_pos, open_len = tokens.pop()
-        except IndexError:
-            raise Exception('LaTeX syntax error')
-        if close_len == 3:
-            raise Exception('LaTeX syntax error')
-        elif close_len == open_len:
-            intervals.append((open_pos, close_pos + close_len - 1))
-        elif open_len > close_len:
-            remainder = open_len - close_len
-            intervals.append((open_pos + remainder, close_pos + close_len - 1))
-            tokens.append((open_pos, remainder))
+    source, target = paths
+    temporary_target = f'{target}.tmp'
+    cache_hit = None
+    diagnostics: List[Diagnostic] = []
+    on_error = diagnostics.append if recover else None
+    try:
+        size = os.path.getsize(source)
+        directory = os.path.dirname(target)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if project:
+            hits = _WORKER_CACHE.hits if _WORKER_CACHE else 0
+            misses = _WORKER_CACHE.misses if _WORKER_CACHE else 0
+            text = TexProject(source, cache=_WORKER_CACHE).normalize(
+                on_error, budget)
+            if _WORKER_CACHE is not None:
+                # A hit if every file of the project was cached.
+                cache_hit = _WORKER_CACHE.misses == misses \
+                    and _WORKER_CACHE.hits > hits
+            with open(temporary_target, 'w',
+                      encoding='utf-8') as normalized_file:
+                normalized_file.write(text)
+        elif _WORKER_CACHE is not None and (budget is None or not recover):
+            hits = _WORKER_CACHE.hits
+            try:
+                text = _WORKER_CACHE.normalize_file(source, budget=budget)
+            except Exception:
+                if not recover:
+                    raise
+                text = _normalize_file_contents(source, on_error=on_error,
+                                                budget=budget)
+            cache_hit = _WORKER_CACHE.hits > hits
+            with open(temporary_target, 'w',
+                      encoding='utf-8') as normalized_file:
+                normalized_file.write(text)
+        elif recover:
+            with _open_source(source) as file, \
+                    open(temporary_target, 'w',
+                         encoding='utf-8') as normalized_file:
+                chunks = iter(functools.partial(file.read, _READ_SIZE), '')
+                separator = ''
+                for normalized in _DEFAULT_NORMALIZER.stream(
+                        chunks, on_error=on_error, budget=budget):
+                    normalized_file.write(separator + normalized)
+                    separator = ' '
         else:
-            raise Exception('LaTeX syntax error')
-    return _excise_intervals(text, intervals)
-
+            with open(temporary_target, 'wb') as normalized_file:
+                separator = b''
+                for normalized in _DEFAULT_NORMALIZER.stream_file(
+                        source, budget=budget):
+                    normalized_file.write(separator + normalized.encode())
+                    separator = b' '
+        os.replace(temporary_target, target)
+    except Exception as error:
+        if os.path.exists(temporary_target):
+            os.remove(temporary_target)
+        return 0, f'{type(error).__name__}: {error}', cache_hit, []
+    return size, None, cache_hit, diagnostics
 
-def _remove_equations(text: str) -> str:
-    r'''
-    Remove inline and display equations.
 
-    Removes inline equations delimited by $ and \(, and removes display
-    equations delimited by $$ and \[. Ignores dollar signs preceded by
-    a single backslash, as the latex compiler renders that as a dollar
-    sign.
+def _normalize_archives(paths: List[str], output_dir: str, jobs: int,
+                        chunk_size: int, compression: str, shard_size: int,
+                        recover: bool, budget: Optional[Budget] = None
+                        ) -> int:
+    '''
+    Normalize the .tex files in the archives at paths in parallel, and
+    write them to shards in output_dir, see ShardWriter. Every record
+    holds the path of a file in an archive, and its normalized text.
 
-    >>> _remove_equations(r'No equation, \$3.50, \$2')
-    'No equation, \\$3.50, \\$2'
+    Returns the exit status, which is 1 if any file or archive failed.
+    '''
+    start = time.perf_counter()
+    total_size = 0
+    normalized = 0
+    recovered = 0
+    latin_1 = 0
+    failures = []
 
-    >>> _remove_equations('An equation $1 + 1\$$ should go')
-    'An equation   should go'
+    def report(name: str, error: Exception) -> None:
+        failures.append(name)
+        print(f'{name}: {type(error).__name__}: {error}', file=sys.stderr)
 
-    >>> _remove_equations('Display equations $$\n 1 + 1 \n $$ too')
-    'Display equations   too'
+    def sources() -> Iterator[Tuple[str, bytes]]:
+        # A member that can not be read is reported under its own name,
+        # and the rest of its archive is still read.
+        for path in paths:
+            try:
+                yield from archive_sources(path, report)
+            except Exception as error:
+                report(path, error)
 
-    >>> _remove_equations(r'These too: \(1 + 1\)')
-    'These too:  '
+    # The files handed to the workers at a time, so that no more than
+    # these are held in memory.
+    batch_size = 4 * jobs * chunk_size
+    source_iterator = sources()
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor, \
+            ShardWriter(output_dir, compression, shard_size) as writer:
+        while True:
+            batch = list(itertools.islice(source_iterator, batch_size))
+            if not batch:
+                break
+            for name, size, text, error, diagnostics, encoding in \
+                    executor.map(functools.partial(_normalize_source,
+                                                   recover=recover,
+                                                   budget=budget),
+                                 batch, chunksize=chunk_size):
+                if encoding != 'utf-8':
+                    latin_1 += 1
+                    print(f'{name}: not UTF-8, decoded as Latin-1',
+                          file=sys.stderr)
+                for diagnostic in diagnostics:
+                    print(f'{name}:{_describe_diagnostic(diagnostic)}',
+                          file=sys.stderr)
+                if error is not None:
+                    failures.append(name)
+                    print(f'{name}: {error}', file=sys.stderr)
+                    continue
+                writer.write({'path': name, 'text': text})
+                normalized += 1
+                recovered += bool(diagnostics)
+                total_size += size
+    seconds = time.perf_counter() - start
 
-    >>> _remove_equations(r'This is an actual equation: \[1 + 1 = \$\]')
-    'This is an actual equation:  '
+    print(f'{normalized} normalized ({recovered} with errors dropped, '
+          f'{latin_1} decoded as Latin-1), '
+          f'{len(failures)} failed in {seconds:.2f} s '
+          f'({normalized / seconds if seconds else 0:.1f} files/s, '
+          f'{total_size / seconds / 1e6 if seconds else 0:.2f} MB/s), '
+          f'{len(writer.paths)} shards written', file=sys.stderr)
+    return 1 if failures else 0
 
-    >>> _remove_equations('$ back $$ to $$ back $')
-    '   '
 
-    >>> _remove_equations(r'$$ \text{$nested$} $$')
-    Traceback (most recent call last):
-        ...
-    Exception: LaTeX syntax error
+def _describe_diagnostic(diagnostic: Diagnostic) -> str:
+    '''
+    Describe a diagnostic for the command line interface, starting
+    with its offset.
 
-    >>> _remove_equations('$ back $$$ to back $$')
-    '  '
+    >>> _describe_diagnostic(Diagnostic('', 0, 9, 'max_size exceeded'))
+    '0: max_size exceeded, 9 characters normalized crudely'
     '''
-    text = _remove_dollar_equations(text)
-    text = _remove_bracket_equations(text)
-    return text
+    if diagnostic.kind.endswith(' exceeded'):
+        return (f'{diagnostic.offset}: {diagnostic.kind}, '
+                f'{diagnostic.length} characters normalized crudely')
+    return (f'{diagnostic.offset}: dropped {diagnostic.length} characters, '
+            f'{diagnostic.kind} in {diagnostic.stage}')
 
 
-def _remove_special_characters(text: str) -> str:
+def main(argv: Optional[List[str]] = None) -> int:
     '''
-    Replace characters that are not letters or whitespaces by a space.
+    Normalize a batch of tex files, in parallel.
+
+    Run "python -m latex_normalizer --help" for the options. Returns
+    the exit status, which is 1 if any file failed.
     '''
-    non_alphabet_regex = re.compile(r'[^a-zA-Z\s]')
-    return non_alphabet_regex.sub(' ', text)
+    parser = argparse.ArgumentParser(
+        prog='python -m latex_normalizer',
+        description='Normalize tex files for NLP. Every file is written '
+                    'to a file with "_normalized" appended to its name.')
+    parser.add_argument(
+        'paths', nargs='*',
+        help='tex files, glob patterns, or directories to search for '
+             '.tex files')
+    parser.add_argument(
+        '--file-list', metavar='FILE',
+        help='file with one path per line, or - for standard input')
+    parser.add_argument(
+        '--output-dir', metavar='DIR',
+        help='directory to write the normalized files to, instead of next '
+             'to the originals')
+    parser.add_argument(
+        '--existing', choices=['skip', 'overwrite'], default='skip',
+        help='what to do with normalized files that already exist '
+             '(default: skip)')
+    parser.add_argument(
+        '--jobs', type=int, default=os.cpu_count(),
+        help='number of worker processes (default: number of cores)')
+    parser.add_argument(
+        '--chunk-size', type=int, default=16,
+        help='number of files handed to a worker at a time (default: 16)')
+    parser.add_argument(
+        '--cache', metavar='FILE',
+        help='sqlite database caching the results across runs')
+    parser.add_argument(
+        '--cache-size', type=int, default=2**30,
+        help='size in bytes above which the least recently used results '
+             'are evicted from the cache (default: 1 GiB)')
+    parser.add_argument(
+        '--project', action='store_true',
+        help='treat every file as the root of a project, and normalize '
+             'the files it includes with \\input and \\include into its '
+             'output')
+    parser.add_argument(
+        '--recover', action='store_true',
+        help='drop the paragraphs with syntax errors and report them, '
+             'instead of failing the whole file')
+    parser.add_argument(
+        '--max-seconds', type=float, metavar='SECONDS',
+        help='seconds after which the rest of a file is normalized '
+             'crudely, in linear time (default: no limit)')
+    parser.add_argument(
+        '--max-size', type=int, metavar='CHARACTERS',
+        help='largest text normalized at once; the larger parts of a '
+             'file are normalized crudely (default: no limit)')
+    parser.add_argument(
+        '--max-depth', type=int, metavar='DEPTH',
+        help='largest nesting depth of brackets normalized in full '
+             '(default: no limit)')
+    parser.add_argument(
+        '--max-matches', type=int, metavar='MATCHES',
+        help='largest number of backslashes, brackets, dollar and percent '
+             'signs normalized at once (default: no limit)')
+    parser.add_argument(
+        '--archives', action='store_true',
+        help='treat every path as a tar, gzip or zip archive, and write '
+             'the normalized .tex files in it to compressed JSON lines '
+             'shards in the output directory')
+    parser.add_argument(
+        '--compression', choices=sorted(ShardWriter._OPENERS),
+        default='gzip', help='compression of the shards (default: gzip)')
+    parser.add_argument(
+        '--shard-size', type=int, default=10000,
+        help='number of files written to a shard (default: 10000)')
+    args = parser.parse_args(argv)
 
+    patterns = list(args.paths)
+    if args.file_list is not None:
+        if args.file_list == '-':
+            patterns += [line.strip() for line in sys.stdin if line.strip()]
+        else:
+            with open(args.file_list, 'r') as file_list:
+                patterns += [line.strip() for line in file_list
+                             if line.strip()]
+    if not patterns:
+        parser.error('no paths given')
+    budget = Budget(args.max_seconds, args.max_size, args.max_depth,
+                    args.max_matches)
+    if budget == Budget():
+        budget = None
+    if args.archives:
+        if args.output_dir is None:
+            parser.error('--archives needs --output-dir')
+        archives = [path for pattern in patterns
+                    for path in sorted(glob.glob(pattern)) or [pattern]]
+        return _normalize_archives(archives, args.output_dir, args.jobs,
+                                   args.chunk_size, args.compression,
+                                   args.shard_size, args.recover, budget)
 
-def _remove_white_space(text: str) -> str:
-    '''
-    Replace white space (including tabs and newlines) by a single space.
-    '''
-    return " ".join(text.split())
+    try:
+        pairs = _collect_paths(patterns, args.output_dir)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.existing == 'skip':
+        todo = [pair for pair in pairs if not os.path.exists(pair[1])]
+    else:
+        todo = pairs
+    skipped = len(pairs) - len(todo)
+
+    start = time.perf_counter()
+    total_size = 0
+    failures = []
+    recovered = 0
+    cache_hits = 0
+    if args.cache is None:
+        initializer, initargs = None, ()
+    else:
+        # Create the database before the workers start using it.
+        NormalizationCache(args.cache, args.cache_size).close()
+        initializer, initargs = _open_worker_cache, (args.cache,
+                                                     args.cache_size)
+    with concurrent.futures.ProcessPoolExecutor(
+            args.jobs, initializer=initializer,
+            initargs=initargs) as executor:
+        results = executor.map(
+            functools.partial(_normalize_file, recover=args.recover,
+                              project=args.project, budget=budget), todo,
+            chunksize=args.chunk_size)
+        for (source, _), (size, error, cache_hit, diagnostics) in zip(
+                todo, results):
+            cache_hits += bool(cache_hit)
+            recovered += bool(diagnostics)
+            for diagnostic in diagnostics:
+                print(f'{source}:{_describe_diagnostic(diagnostic)}',
+                      file=sys.stderr)
+            if error is None:
+                total_size += size
+            else:
+                failures.append(source)
+                print(f'{source}: {error}', file=sys.stderr)
+    seconds = time.perf_counter() - start
+
+    normalized = len(todo) - len(failures)
+    print(f'{normalized} normalized ({recovered} with errors dropped), '
+          f'{skipped} skipped, {len(failures)} failed in {seconds:.2f} s '
+          f'({normalized / seconds if seconds else 0:.1f} files/s, '
+          f'{total_size / seconds / 1e6 if seconds else 0:.2f} MB/s)',
+          file=sys.stderr)
+    if args.cache is not None:
+        print(f'cache: {cache_hits} hits, {len(todo) - cache_hits} misses',
+              file=sys.stderr)
+    return 1 if failures else 0
 
 
 if __name__ == "__main__":
+    # Without arguments, run the tests.
+    if len(sys.argv) > 1:
+        sys.exit(main())
     import doctest
     doctest.testmod()